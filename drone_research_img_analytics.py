@@ -6,167 +6,795 @@
 import numpy as np
 import json
 import math
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# global and per-lane speed averages, updated one car at a time so every
+# writer can share a single pass. cars without a valid speed are skipped
+class SpeedSummary:
+    def __init__(self):
+        self.lanes = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, car):
+        lane = self.lanes.setdefault(car["lane"], [0, 0.0])
+        if car["speed"] is not False:
+            lane[0] += 1
+            lane[1] += car["speed"]
+            self.count += 1
+            self.total += car["speed"]
+
+    def average_speed(self):
+        return self.total / self.count if self.count else np.nan
+
+    def lane_speeds(self):
+        return {l: total/count if count else np.nan for l, (count, total) in self.lanes.items()}
+
+    # fold in the counts from another summary (e.g. another clip). lanes=False
+    # keeps only the overall counts, for summaries whose lane indices come from a
+    # different lane model
+    def merge(self, other, lanes=True):
+        for l, (count, total) in (other.lanes.items() if lanes else ()):
+            lane = self.lanes.setdefault(l, [0, 0.0])
+            lane[0] += count
+            lane[1] += total
+        self.count += other.count
+        self.total += other.total
+        return self
+
+def car_record(c):
+    return {
+        "ID" : c["ID"],
+        "start_frame" : c["start_frame"],
+        "end_frame" : c["end_frame"],
+        "start_coord" : np.asarray(c["start_coord"]).tolist(),
+        "end_coord" : np.asarray(c["end_coord"]).tolist(),
+        "speed" : c["speed"],
+        "lane" : c["lane"]
+    }
+
+# numpy scalars coming out of the vectorized stats
+def json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(repr(o))
+
+# output sinks: write(car) as each car is finalized, close(summary) at the end
+
+# one JSON object per line, followed by a summary line
+class NDJSONWriter:
+    def __init__(self, fname):
+        self.f = open(fname, "w")
+
+    def write(self, c):
+        self.f.write(json.dumps(car_record(c), default=json_default) + "\n")
+
+    def close(self, summary):
+        self.f.write(json.dumps({"summary": {"average_speed": summary.average_speed(),
+                                             "lane_speeds": summary.lane_speeds()}},
+                                default=json_default) + "\n")
+        self.f.close()
+
+# same layout as the old WriteJSON output ({"cars": [...], "average_speed": x}),
+# streamed one car at a time instead of built in memory
+class JSONWriter:
+    def __init__(self, fname):
+        self.f = open(fname, "w")
+        self.f.write('{"cars": [')
+        self.first = True
+
+    def write(self, c):
+        self.f.write(("\n" if self.first else ",\n") + json.dumps(car_record(c), default=json_default))
+        self.first = False
+
+    def close(self, summary):
+        self.f.write('\n], "average_speed": ' + json.dumps(summary.average_speed(), default=json_default) + "}\n")
+        self.f.close()
+
+# compact columnar .npz, reload with np.load(fname). speed is nan where unknown
+class NPZWriter:
+    def __init__(self, fname):
+        self.fname = fname
+        self.cols = {"ID": [], "start_frame": [], "end_frame": [], "start_coord": [],
+                     "end_coord": [], "speed": [], "lane": []}
+
+    def write(self, c):
+        for name, col in self.cols.items():
+            col.append(c[name])
+        if c["speed"] is False:
+            self.cols["speed"][-1] = np.nan
+
+    def close(self, summary):
+        data = {name: np.asarray(col) for name, col in self.cols.items()}
+        data["start_coord"] = data["start_coord"].reshape(-1, 2)
+        data["end_coord"] = data["end_coord"].reshape(-1, 2)
+        data["speed"] = data["speed"].astype(np.float64)
+        lane_speeds = summary.lane_speeds()
+        data["lane_ids"] = np.asarray(list(lane_speeds.keys()))
+        data["lane_speeds"] = np.asarray(list(lane_speeds.values()), dtype=np.float64)
+        data["average_speed"] = np.float64(summary.average_speed())
+        np.savez_compressed(self.fname, **data)
+
+# human readable report, same text as the old WriteStats
+class StatsWriter:
+    def __init__(self, fname):
+        self.f = open(fname, "w")
+
+    def write(self, c):
+        self.f.write("\n \n Car : " + str(c["ID"]) +
+                     "\n Start frame: " + str(c["start_frame"]) + " End frame: " + str(c["end_frame"]) +
+                     "\n Start coord: " + str(c["start_coord"]) + " End coord: " + str(c["end_coord"]) +
+                     "\n Speed: " + str(c["speed"]) +
+                     "\n Lane: " + str(c["lane"]))
+
+    def close(self, summary):
+        for l, speed in summary.lane_speeds().items():
+            self.f.write("\n \n Lane " + str(l) + " speed: " + str(speed) + " m/s")
+        self.f.write("\n \n Average speed: " + str(summary.average_speed()) + " m/s")
+        self.f.close()
+
+WRITERS = {
+    ".ndjson": NDJSONWriter,
+    ".jsonl": NDJSONWriter,
+    ".json": JSONWriter,
+    ".npz": NPZWriter,
+    ".txt": StatsWriter,
+}
+
+# fans each car out to every sink and keeps the shared speed summary
+class CarWriter:
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.summary = SpeedSummary()
+
+    @classmethod
+    def open(cls, *fnames):
+        return cls([WRITERS.get(os.path.splitext(f)[1], StatsWriter)(f) for f in fnames])
+
+    def write(self, car):
+        self.summary.add(car)
+        for sink in self.sinks:
+            sink.write(car)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close(self.summary)
+        return self.summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 def WriteJSON(stats, fname):
-    data = {}
-    data['cars'] = []
-    
-    for c in stats:
-        data['cars'].append({
-            "ID" : c["ID"],
-            "start_frame" : c["start_frame"],
-            "end_frame" : c["end_frame"],
-            "start_coord" : c["start_coord"].tolist(),
-            "end_coord" : c["end_coord"].tolist(),
-            "speed" : c["speed"],
-            "lane" : c["lane"]
-            # "vectors" : c["vectors"],
-            # "angles" : c["angles"]
-            # "lin_reg_slope" : c["lin_reg_slope"],
-            # "lin_reg_inter" : c["lin_reg_inter"]
-        })
-    data["average_speed"] = np.mean([ c["speed"] for c in stats])
-    
-    with open(fname, "w+") as f:
-        json.dump(data, f, indent = 4)
+    with CarWriter([JSONWriter(fname)]) as w:
+        for c in stats:
+            w.write(c)
 
 def WriteStats(stats, fname):
-    lanes = {}
-    with open(fname, "w+") as f:
+    with CarWriter([StatsWriter(fname)]) as w:
         for c in stats:
-            f.write("\n \n Car : " + str(c["ID"]) )
-            f.write("\n Start frame: "+ str(c["start_frame"])+ " End frame: "+ str(c["end_frame"]))
-            f.write("\n Start coord: "+ str(c["start_coord"])+ " End coord: "+ str(c["end_coord"]))
-            f.write("\n Speed: "+ str(c["speed"]))
-            f.write("\n Lane: "+ str(c["lane"]))
-            # f.write("\n Vectors: "+ str(c["vectors"]))
-            # f.write("\n Angles: "+ str(c["angles"]))
-            # f.write("\n Linear Regression Slope: "+ str(c["lin_reg_slope"]))
-            # f.write("\n Linear Regression Intercept: "+ str(c["lin_reg_inter"]))
-            if c["lane"] not in lanes.keys():
-                lanes[c["lane"]] = [c["speed"]]
-            else:
-                lanes[c["lane"]].append(c["speed"])
-        for l in lanes:
-            f.write("\n \n Lane " + str(l) + " speed: " + str(np.mean(lanes[l])) + " m/s")
-        avg_speed = np.mean([ c["speed"]  for c in stats ])
-        f.write("\n \n Average speed: " + str(avg_speed) + " m/s")
+            w.write(c)
     return None
 
-def ImageAnalytics(trackableObjects, VIDEO_FPS, DIST_PER_PIXEL):
-    stats = []  
-    
-    for key, obj in trackableObjects.items():
+# struct-of-arrays view over every tracked trajectory
+# frames/coords hold all points back to back, track i spans offsets[i]:offsets[i+1]
+class TrajectoryStore:
+    def __init__(self, ids, frames, coords, offsets):
+        self.ids = ids
+        self.frames = frames
+        self.coords = coords
+        self.offsets = offsets
+        self.start = offsets[:-1]
+        self.end = offsets[1:] - 1
 
-        traj = obj.trajectory
-        
-        # store all computed statistics for this object
-        car = {}
-        car["ID"] = obj.objectID    
+    # tracks is an iterable of (objectID, [[frame, [x, y]], ...]) pairs
+    @classmethod
+    def from_tracks(cls, tracks):
+        ids = []
+        lengths = []
+        frames = []
+        coords = []
+        for ID, traj in tracks:
+            ids.append(ID)
+            lengths.append(len(traj))
+            for t in traj:
+                frames.append(t[0])
+                coords.append(t[1])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        return cls(ids, np.asarray(frames), coords, offsets)
+
+    @classmethod
+    def from_trackable(cls, trackableObjects):
+        return cls.from_tracks((obj.objectID, obj.trajectory) for obj in trackableObjects.values())
+
+    # serialized tracker output: columnar .npz (see save) or JSON mapping
+    # objectID -> [[frame, [x, y]], ...]
+    @classmethod
+    def load(cls, fname):
+        if fname.endswith('.json'):
+            with open(fname) as f:
+                tracks = json.load(f)
+            return cls.from_tracks((int(ID) if ID.isdigit() else ID, traj) for ID, traj in tracks.items())
+        with np.load(fname) as data:
+            return cls(data["ids"].tolist(), data["frames"], data["coords"], data["offsets"])
+
+    def save(self, fname):
+        np.savez_compressed(fname, ids=np.asarray(self.ids), frames=self.frames, coords=self.coords,
+                            offsets=self.offsets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def start_frames(self):
+        return self.frames[self.start]
+
+    def end_frames(self):
+        return self.frames[self.end]
+
+    def start_coords(self):
+        return self.coords[self.start]
+
+    def end_coords(self):
+        return self.coords[self.end]
+
+    def durations(self, VIDEO_FPS):
+        return (self.end_frames() - self.start_frames()) / VIDEO_FPS
+
+    def displacements(self):
+        return self.end_coords() - self.start_coords()
+
+    def distances(self, DIST_PER_PIXEL):
+        return DIST_PER_PIXEL * np.hypot(*self.displacements().T)
+
+    # nan where the object was only seen for a single frame
+    def speeds(self, VIDEO_FPS, DIST_PER_PIXEL):
+        time = self.durations(VIDEO_FPS)
+        dist = self.distances(DIST_PER_PIXEL)
+        out = np.full(len(self), np.nan)
+        np.divide(dist, time, out=out, where=time > 0)
+        return out
 
-        # duration the particular object was tracked
-        car["start_frame"] = traj[0][0]
-        car["end_frame"] = traj[-1][0]
-        frame_len = car["end_frame"] - car["start_frame"]
+    # True where the object moves right (increasing x)
+    def directions(self):
+        return self.displacements()[:, 0] > 0
 
-        time = 1/VIDEO_FPS * frame_len
+    def regression(self, method='ols'):
+        return batch_linear_reg(self.coords, self.offsets, method)
 
-        # distance travelled by the particular object
-        car["start_coord"] = traj[0][1]
-        car["end_coord"] = traj[-1][1]
-        
-        pixel_dist = np.sqrt( (car["start_coord"][0] - car["end_coord"][0])**2 + (car["start_coord"][1] - car["end_coord"][1])**2  )
+    # dict-per-car view matching the old ImageAnalytics output
+    def to_cars(self, VIDEO_FPS, DIST_PER_PIXEL, **columns):
+        speeds = self.speeds(VIDEO_FPS, DIST_PER_PIXEL)
+        start_frames = self.start_frames().tolist()
+        end_frames = self.end_frames().tolist()
+        start_coords = self.start_coords()
+        end_coords = self.end_coords()
+        cars = []
+        for i in range(len(self)):
+            car = {}
+            car["ID"] = self.ids[i]
+            car["start_frame"] = start_frames[i]
+            car["end_frame"] = end_frames[i]
+            car["start_coord"] = start_coords[i]
+            car["end_coord"] = end_coords[i]
+            car["speed"] = False if np.isnan(speeds[i]) else float(speeds[i])
+            for name, col in columns.items():
+                car[name] = col[i]
+            cars.append(car)
+        return cars
 
-        distance = DIST_PER_PIXEL * pixel_dist      
+# online statistics for one active track, no trajectory points are kept
+# regression sums are taken relative to the first point to limit cancellation
+class TrackStats:
+    __slots__ = ("ID", "start_frame", "start_coord", "end_frame", "end_coord",
+                 "n", "sx", "sy", "sxx", "sxy", "syy")
 
-        #speed = distance / time if time >0 else False      
-        if (time >0):
-            speed = distance/time
+    def __init__(self, ID, frame, coord):
+        self.ID = ID
+        self.start_frame = frame
+        self.start_coord = np.asarray(coord, dtype=np.float64)
+        self.end_frame = frame
+        self.end_coord = self.start_coord
+        self.n = 1
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.syy = 0.0
+
+    def add(self, frame, coord):
+        coord = np.asarray(coord, dtype=np.float64)
+        dx = coord[0] - self.start_coord[0]
+        dy = coord[1] - self.start_coord[1]
+        self.end_frame = frame
+        self.end_coord = coord
+        self.n += 1
+        self.sx += dx
+        self.sy += dy
+        self.sxx += dx*dx
+        self.sxy += dx*dy
+        self.syy += dy*dy
+
+    def regression(self):
+        xbar = self.sx/self.n
+        ybar = self.sy/self.n
+        m, b = line_from_moments(xbar, ybar, self.sxx - self.sx*xbar,
+                                 self.sxy - self.sx*ybar, self.syy - self.sy*ybar)
+        # undo the shift to the first point
+        if np.isinf(m):
+            return (float(m), float(b) + self.start_coord[0])
+        return (float(m), float(b) + self.start_coord[1] - m*self.start_coord[0])
+
+    def to_car(self, VIDEO_FPS, DIST_PER_PIXEL, lane_model=None):
+        car = {}
+        car["ID"] = self.ID
+        car["start_frame"] = self.start_frame
+        car["end_frame"] = self.end_frame
+        car["start_coord"] = self.start_coord
+        car["end_coord"] = self.end_coord
+        car["direction"] = 'right' if self.start_coord[0] < self.end_coord[0] else 'left'
+        time = (self.end_frame - self.start_frame) / VIDEO_FPS
+        pixel_dist = np.hypot(*(self.end_coord - self.start_coord))
+        car["speed"] = DIST_PER_PIXEL * pixel_dist / time if time > 0 else False
+        car["lin_reg_slope"], car["lin_reg_inter"] = self.regression()
+        if lane_model is None:
+            car["lane"] = int(((self.start_coord[1] + self.end_coord[1])//2)/100) - 3
         else:
-            speed = False
+            car["lane"] = int(lane_model.assign([car["lin_reg_slope"]], [car["lin_reg_inter"]],
+                                                [car["direction"] == 'right'])[0])
+        return car
 
-        car["speed"] = speed
-        print("Speed of car ", car["ID"], " is ", car["speed"] , "m/s")
-        stats.append(car)       
+# streaming counterpart of regressionlaneFinder, fed one tracker update per frame
+# memory is bounded by the number of active tracks (plus the set of finished IDs);
+# a car is finalized and returned once it has not been updated for more than
+# max_gap frames. max_gap should match the tracker's maxDisappeared: the
+# default of 1 only suits a tracker that drops an object after a single missed
+# frame, with a longer dropout the car is split in two records with the same ID
+# (a warning is printed when a finished ID comes back).
+# pass a cached site LaneModel to assign lanes online, and a CarWriter to
+# write cars out as they are finalized
+class StreamingAnalytics:
+    def __init__(self, VIDEO_FPS, DIST_PER_PIXEL, max_gap=1, lane_model=None, writer=None):
+        self.fps = VIDEO_FPS
+        self.dpp = DIST_PER_PIXEL
+        self.max_gap = max_gap
+        self.lane_model = lane_model
+        self.writer = writer
+        self.active = {}
+        self.finished = set()
+        self.frame = None
+        self.summary = writer.summary if writer is not None else SpeedSummary()
 
+    # objects maps objectID -> centroid for the given frame (centroid tracker output)
+    def update(self, frame, objects):
+        self.frame = frame
+        for ID, coord in objects.items():
+            track = self.active.get(ID)
+            if track is None:
+                if ID in self.finished:
+                    print("warning: object %s reappeared at frame %s after being finalized, "
+                          "max_gap=%d is shorter than the tracker's maxDisappeared" % (ID, frame, self.max_gap),
+                          file=sys.stderr)
+                self.active[ID] = TrackStats(ID, frame, coord)
+            else:
+                track.add(frame, coord)
+        stale = [ID for ID, t in self.active.items() if frame - t.end_frame > self.max_gap]
+        return [self.finalize(ID) for ID in stale]
 
-    avg_speed = np.mean([ c["speed"] for c in stats if c["speed"] is not False ])
-    print("Average speed is ", avg_speed, " m/s")
+    # finalize every remaining track, e.g. at the end of the video
+    def flush(self):
+        return [self.finalize(ID) for ID in list(self.active)]
+
+    def finalize(self, ID):
+        car = self.active.pop(ID).to_car(self.fps, self.dpp, self.lane_model)
+        self.finished.add(ID)
+        if self.writer is not None:
+            self.writer.write(car)
+        else:
+            self.summary.add(car)
+        return car
+
+    # running speeds over the cars finalized so far
+    def average_speed(self):
+        return self.summary.average_speed()
+
+    def lane_speeds(self):
+        return self.summary.lane_speeds()
+
+def ImageAnalytics(trackableObjects, VIDEO_FPS, DIST_PER_PIXEL, verbose=True):
+    store = TrajectoryStore.from_trackable(trackableObjects)
+    stats = store.to_cars(VIDEO_FPS, DIST_PER_PIXEL)
+
+    if verbose:
+        for car in stats:
+            print("Speed of car ", car["ID"], " is ", car["speed"] , "m/s")
+
+        avg_speed = np.nanmean(store.speeds(VIDEO_FPS, DIST_PER_PIXEL))
+        print("Average speed is ", avg_speed, " m/s")
 
     return stats
 
+# slope/intercept from centered second moments, works on scalars or arrays
+# vertical tracks (no x spread) give slope inf and the x position as intercept,
+# stationary tracks (no spread at all) give a flat line through the point
+def line_from_moments(xbar, ybar, sxx, sxy, syy):
+    xbar, ybar, sxx, sxy, syy = np.broadcast_arrays(*map(np.asarray, (xbar, ybar, sxx, sxy, syy)))
+    ok = sxx > 0
+    m = np.divide(sxy, sxx, out=np.zeros(sxx.shape), where=ok)
+    b = ybar - m*xbar
+    vertical = ~ok & (syy > 0)
+    m = np.where(vertical, np.inf, m)
+    b = np.where(vertical, xbar, b)
+    return (m, b)
+
 def linear_reg(x, y):
-    xbar = np.mean(x)
-    ybar = np.mean(y)
-    numer = 0
-    denom = 0
-    for i in range(len(x)):
-        numer += (x[i] - xbar)*(y[i]-ybar)
-        denom += (x[i] - xbar)**2
-    m = numer/denom
-    b = ybar - (m*xbar)
+    coords = np.column_stack((x, y)).astype(np.float64)
+    m, b = batch_linear_reg(coords, np.array([0, len(coords)]))
+    return (m[0], b[0])
+
+# segmented reductions over a flat point array: track i spans offsets[i]:offsets[i+1]
+def segment_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+def segment_sum(values, seg, count):
+    return np.bincount(seg, weights=values, minlength=count)
+
+# median of values within each segment (nan for empty segments)
+def segment_median(values, seg, count):
+    order = np.lexsort((values, seg))
+    values = values[order]
+    sizes = np.bincount(seg, minlength=count)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    out = np.full(count, np.nan)
+    has = sizes > 0
+    lo = starts[has] + (sizes[has] - 1)//2
+    hi = starts[has] + sizes[has]//2
+    out[has] = (values[lo] + values[hi]) * 0.5
+    return out
+
+# least squares fit for every track at once
+def batch_ols(coords, offsets):
+    count = len(offsets) - 1
+    seg = segment_ids(offsets)
+    n = np.maximum(np.diff(offsets), 1)
+    xbar = segment_sum(coords[:, 0], seg, count) / n
+    ybar = segment_sum(coords[:, 1], seg, count) / n
+    dx = coords[:, 0] - xbar[seg]
+    dy = coords[:, 1] - ybar[seg]
+    return line_from_moments(xbar, ybar, segment_sum(dx*dx, seg, count),
+                             segment_sum(dx*dy, seg, count), segment_sum(dy*dy, seg, count))
+
+# Theil-Sen estimate for every track at once. slopes are taken between points
+# half a track apart (i, i + n//2), which keeps the pair count linear in n and
+# still tolerates jitter on up to ~29% of the points
+def batch_theil_sen(coords, offsets):
+    count = len(offsets) - 1
+    lengths = np.diff(offsets)
+    half = lengths // 2
+    npairs = lengths - half
+    npairs[half == 0] = 0
+    pair_seg = np.repeat(np.arange(count), npairs)
+    local = np.arange(len(pair_seg)) - np.repeat(np.cumsum(npairs) - npairs, npairs)
+    i = offsets[:-1][pair_seg] + local
+    j = i + half[pair_seg]
+    dx = coords[j, 0] - coords[i, 0]
+    dy = coords[j, 1] - coords[i, 1]
+    sloped = dx != 0
+    m = segment_median(dy[sloped] / dx[sloped], pair_seg[sloped], count)
+
+    seg = segment_ids(offsets)
+    no_slope = np.isnan(m)
+    b = segment_median(coords[:, 1] - np.where(no_slope, 0, m)[seg] * coords[:, 0], seg, count)
+
+    # tracks with no usable pair are vertical or stationary, same convention as OLS
+    if no_slope.any():
+        m_ols, b_ols = batch_ols(coords, offsets)
+        m[no_slope] = m_ols[no_slope]
+        b[no_slope] = b_ols[no_slope]
     return (m, b)
 
-def regressionlaneFinder(trackableObjects, VIDEO_FPS, DIST_PER_PIXEL):
-    stats = []  
-    lanes = {}  
+REGRESSION_METHODS = {
+    'ols': batch_ols,
+    'theil_sen': batch_theil_sen,
+}
 
-    for key, obj in trackableObjects.items():
+def batch_linear_reg(coords, offsets, method='ols'):
+    return REGRESSION_METHODS[method](coords, offsets)
 
-        traj = obj.trajectory
-        x_vals = []
-        y_vals = []
-        
-        # store all computed statistics for this object
-        car = {}
-        car["ID"] = obj.objectID    
+# point on each regression line closest to c, and the line's unit direction
+def line_geometry(slopes, inters, c):
+    slopes = np.asarray(slopes, dtype=np.float64)
+    inters = np.asarray(inters, dtype=np.float64)
+    vertical = np.isinf(slopes)
+    p0 = np.column_stack((np.where(vertical, inters, 0.0), np.where(vertical, 0.0, inters)))
+    d = np.column_stack((np.where(vertical, 0.0, 1.0), np.where(vertical, 1.0, slopes)))
+    d /= np.linalg.norm(d, axis=1, keepdims=True)
+    t = np.einsum('ij,ij->i', c - p0, d)
+    return p0 + t[:, None]*d, d
 
-        # duration the particular object was tracked
-        car["start_frame"] = traj[0][0]
-        car["end_frame"] = traj[-1][0]
+# lanes inferred from the per-car regression lines instead of a fixed pixel rule.
+# lines are projected onto the normal of the dominant road direction, giving one
+# signed offset per car; lane centerlines are the peaks of the offset histogram,
+# found separately for each travel direction. fitting is O(cars), assignment is a
+# lookup against a handful of cached centers
+class LaneModel:
+    def __init__(self, center, normal, centers, directions):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.normal = np.asarray(normal, dtype=np.float64)
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.directions = np.asarray(directions, dtype=bool)
 
-        #Note that full trajectory is in traj!
+    # lane_width in meters, converted to pixels so the bins follow altitude
+    @classmethod
+    def fit(cls, slopes, inters, directions, midpoints, DIST_PER_PIXEL, lane_width=3.7, min_frac=0.02):
+        directions = np.asarray(directions, dtype=bool)
+        center = np.asarray(midpoints, dtype=np.float64).mean(axis=0)
+        q, d = line_geometry(slopes, inters, center)
 
-        frame_len = car["end_frame"] - car["start_frame"]
-        time = 1/VIDEO_FPS * frame_len
+        # dominant road direction, averaged on doubled angles so +/- headings agree
+        theta = 2*np.arctan2(d[:, 1], d[:, 0])
+        phi = 0.5*np.arctan2(np.sin(theta).mean(), np.cos(theta).mean())
+        normal = np.array([-np.sin(phi), np.cos(phi)])
+        offsets = (q - center) @ normal
 
-        # distance travelled by the particular object
-        car["start_coord"] = traj[0][1]
-        car["end_coord"] = traj[-1][1]
+        width_px = lane_width / DIST_PER_PIXEL
+        centers = []
+        dirs = []
+        for heading in (False, True):
+            sel = offsets[directions == heading]
+            if len(sel) == 0:
+                continue
+            peaks = histogram_peaks(sel, width_px/4, 2, max(1, min_frac*len(sel)))
+            centers.extend(peaks)
+            dirs.extend([heading]*len(peaks))
+        order = np.argsort(centers)
+        return cls(center, normal, np.asarray(centers)[order], np.asarray(dirs, dtype=bool)[order])
 
-        if(car["start_coord"][0] < car["end_coord"][0]):
-            car["direction"] = 'right'
-        else:
-            car["direction"] = 'left'
-        
-        pixel_dist = np.sqrt( (car["start_coord"][0] - car["end_coord"][0])**2 + (car["start_coord"][1] - car["end_coord"][1])**2)
-        distance = DIST_PER_PIXEL * pixel_dist  
-        speed = distance / time if time >0 else False       
-        car["speed"] = speed
-
-        car["lane"] = int(((car["start_coord"][1] + car["end_coord"][1])//2)/100) - 3
+    def offsets(self, slopes, inters):
+        q, d = line_geometry(slopes, inters, self.center)
+        return (q - self.center) @ self.normal
+
+    # lane index (ordered across the road) of the nearest center with the same heading
+    def assign(self, slopes, inters, directions):
+        off = self.offsets(slopes, inters)
+        directions = np.asarray(directions, dtype=bool)
+        lanes = np.full(len(off), -1, dtype=np.int64)
+        for heading in (False, True):
+            idx = np.flatnonzero(self.directions == heading)
+            sel = directions == heading
+            if len(idx) == 0 or not sel.any():
+                continue
+            c = self.centers[idx]
+            bounds = (c[1:] + c[:-1]) / 2
+            lanes[sel] = idx[np.searchsorted(bounds, off[sel])]
+        return lanes
+
+    def save(self, fname):
+        np.savez(fname, center=self.center, normal=self.normal, centers=self.centers,
+                 directions=self.directions)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            return cls(data["center"], data["normal"], data["centers"], data["directions"])
+
+# smoothed histogram maxima, one per window of +/- radius bins, refined to the
+# mean of the values that fall closest to each peak
+def histogram_peaks(values, bin_width, radius, min_count):
+    lo = values.min()
+    bins = ((values - lo) // bin_width).astype(np.int64)
+    counts = np.bincount(bins).astype(np.float64)
+    smooth = np.convolve(np.pad(counts, 1), [0.25, 0.5, 0.25], mode='valid')
+    padded = np.pad(smooth, radius, constant_values=-1)
+    window = np.lib.stride_tricks.sliding_window_view(padded, 2*radius + 1)
+    is_peak = (smooth == window.max(axis=1)) & (smooth >= min_count)
+    # flat tops produce neighbouring equal maxima, keep the first of each run
+    is_peak[1:] &= ~is_peak[:-1]
+    peaks = lo + (np.flatnonzero(is_peak) + 0.5)*bin_width
+    if len(peaks) == 0:
+        return np.array([np.median(values)])
+    nearest = np.abs(values[:, None] - peaks[None, :]).argmin(axis=1)
+    sums = np.bincount(nearest, weights=values, minlength=len(peaks))
+    n = np.bincount(nearest, minlength=len(peaks))
+    return np.where(n > 0, sums / np.maximum(n, 1), peaks)
+
+# lane model for a camera site: reuse the cached centerlines when present,
+# otherwise fit on this video and store them for later videos from the site
+def site_lane_model(site, slopes, inters, directions, midpoints, DIST_PER_PIXEL, cache_dir='lane_cache',
+                    write_cache=True):
+    if site is None:
+        return LaneModel.fit(slopes, inters, directions, midpoints, DIST_PER_PIXEL)
+    fname = os.path.join(cache_dir, str(site) + '.npz')
+    if os.path.exists(fname):
+        return LaneModel.load(fname)
+    model = LaneModel.fit(slopes, inters, directions, midpoints, DIST_PER_PIXEL)
+    if write_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = fname[:-4] + '.' + str(os.getpid()) + '.tmp.npz'
+        model.save(tmp)
+        os.replace(tmp, fname)
+    return model
+
+# what LaneModel.fit needs from a store: regression lines, headings, midpoints
+def lane_features(store, reg_method='ols'):
+    slopes, inters = store.regression(reg_method)
+    midpoints = (store.start_coords() + store.end_coords()) / 2
+    return slopes, inters, store.directions(), midpoints
+
+# worker for site_models: lane features of one clip
+def clip_features(entry, reg_method='ols'):
+    return lane_features(TrajectoryStore.load(entry["path"]), reg_method)
+
+# one lane model per site in entries, fitted on the pooled tracks of all of that
+# site's clips (or read from the cache) and cached, so lane k is the same lane in
+# every clip of a site. features of the clips of uncached sites are computed with
+# pool.map when a pool is given, and returned alongside the models (a list
+# matching entries, None where not computed) so the clips need not redo them
+def site_models(entries, reg_method='ols', cache_dir='lane_cache', pool=None):
+    models = {}
+    for site in dict.fromkeys(e["site"] for e in entries if e["site"] is not None):
+        fname = os.path.join(cache_dir, str(site) + '.npz')
+        if os.path.exists(fname):
+            models[site] = LaneModel.load(fname)
+    todo = [k for k, e in enumerate(entries) if e["site"] is not None and e["site"] not in models]
+    mapper = map if pool is None else pool.map
+    features = [None]*len(entries)
+    for k, f in zip(todo, mapper(clip_features, [entries[k] for k in todo], [reg_method]*len(todo))):
+        features[k] = f
+    for site in dict.fromkeys(entries[k]["site"] for k in todo):
+        group = [k for k in todo if entries[k]["site"] == site]
+        slopes, inters, directions, midpoints = (np.concatenate(f) for f in zip(*(features[k] for k in group)))
+        models[site] = site_lane_model(site, slopes, inters, directions, midpoints,
+                                       entries[group[0]]["dist_per_pixel"], cache_dir)
+    return models, features
+
+# per-car stats with regression lines and lanes for a whole store, no printing.
+# model is a prebuilt LaneModel, otherwise the site's (cached) model is used;
+# features are the store's lane_features when already computed
+def lane_stats(store, VIDEO_FPS, DIST_PER_PIXEL, reg_method='ols', site=None, cache_dir='lane_cache',
+               write_cache=True, model=None, features=None):
+    direction = np.where(store.directions(), 'right', 'left')
+    slopes, inters, directions, midpoints = lane_features(store, reg_method) if features is None else features
+    if model is None:
+        model = site_lane_model(site, slopes, inters, directions, midpoints, DIST_PER_PIXEL, cache_dir,
+                                write_cache)
+    lane = model.assign(slopes, inters, directions)
+
+    return store.to_cars(VIDEO_FPS, DIST_PER_PIXEL, direction=direction.tolist(), lane=lane.tolist(),
+                         lin_reg_slope=slopes.tolist(), lin_reg_inter=inters.tolist())
+
+def regressionlaneFinder(trackableObjects, VIDEO_FPS, DIST_PER_PIXEL, reg_method='ols', site=None,
+                         cache_dir='lane_cache', verbose=True):
+    store = TrajectoryStore.from_trackable(trackableObjects)
+    lanes = {}
+
+    stats = lane_stats(store, VIDEO_FPS, DIST_PER_PIXEL, reg_method, site, cache_dir)
+    if not verbose:
+        return stats
+
+    for car in stats:
         if car["lane"] not in lanes.keys():
             lanes[car["lane"]] = [car["ID"]]
         else:
             lanes[car["lane"]].append(car["ID"])
 
-        stats.append(car)   
-        for t in traj:
-            x_vals.append(t[1][0])
-            y_vals.append(t[1][1])
-        m, b = linear_reg(x_vals, y_vals)
-        car["lin_reg_slope"] = m
-        car["lin_reg_inter"] = b
-
-    avg_speed = np.mean([ c["speed"] for c in stats if c["speed"] is not False ])
+    avg_speed = np.nanmean(store.speeds(VIDEO_FPS, DIST_PER_PIXEL))
     print("Average speed is ", avg_speed, " m/s")
 
-    newlist = sorted(stats, key=lambda car: car['start_coord'][1]) 
-    twolist = sorted(stats, key=lambda car: car['lane']) 
-
-    for car in newlist:
-        print("Car ", car["ID"], " is moving ", car["direction"])
+    order = np.argsort(store.start_coords()[:, 1], kind='stable')
+    for i in order:
+        print("Car ", stats[i]["ID"], " is moving ", stats[i]["direction"])
     
     print(lanes)
 
     return stats
+
+# one entry per clip: {"path", "site", "fps", "dist_per_pixel"}. source is either a
+# directory of serialized tracker outputs (.npz/.json) or a manifest file with one
+# JSON object (or bare path) per line; missing fields fall back to the defaults
+def read_manifest(source, VIDEO_FPS, DIST_PER_PIXEL):
+    if os.path.isdir(source):
+        entries = [{"path": os.path.join(source, f)} for f in sorted(os.listdir(source))
+                   if f.endswith(('.npz', '.json'))]
+    else:
+        entries = []
+        base = os.path.dirname(source)
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                entry = json.loads(line) if line.startswith('{') else {"path": line}
+                entry["path"] = os.path.join(base, entry["path"])
+                entries.append(entry)
+    for entry in entries:
+        entry.setdefault("site", None)
+        entry.setdefault("fps", VIDEO_FPS)
+        entry.setdefault("dist_per_pixel", DIST_PER_PIXEL)
+    return entries
+
+# worker for batch_analytics: one clip, nothing shared with the other workers.
+# model is the site's lane model from the parent; clips without a site fit their
+# own and never write the cache
+def analyze_clip(entry, out_dir=None, reg_method='ols', cache_dir='lane_cache', model=None, features=None):
+    t0 = time.perf_counter()
+    store = TrajectoryStore.load(entry["path"])
+    stats = lane_stats(store, entry["fps"], entry["dist_per_pixel"], reg_method, entry["site"], cache_dir,
+                       write_cache=False, model=model, features=features)
+    if out_dir is not None:
+        name = os.path.splitext(os.path.basename(entry["path"]))[0]
+        writer = CarWriter.open(os.path.join(out_dir, name + '.ndjson'))
+    else:
+        writer = CarWriter([])
+    with writer:
+        for car in stats:
+            writer.write(car)
+    return entry, writer.summary, len(stats), time.perf_counter() - t0
+
+# runs analyze_clip over every clip in a process pool and merges the speed
+# summaries per site and overall. lane models are built once per site up front,
+# from clip features computed in the same pool; clips without a site each have
+# their own lanes, so only their overall speeds are merged. the summary's
+# "cars_with_speed" only counts cars with a valid speed, per-clip "cars" counts
+# every car
+def batch_analytics(source, VIDEO_FPS, DIST_PER_PIXEL, out_dir=None, workers=None, reg_method='ols',
+                    cache_dir='lane_cache', log=sys.stderr):
+    entries = read_manifest(source, VIDEO_FPS, DIST_PER_PIXEL)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    sites = {}
+    total = SpeedSummary()
+    clips = []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        models, features = site_models(entries, reg_method, cache_dir, pool)
+        futures = [pool.submit(analyze_clip, e, out_dir, reg_method, cache_dir, models.get(e["site"]), f)
+                   for e, f in zip(entries, features)]
+        for k, fut in enumerate(as_completed(futures)):
+            entry, summary, ncars, secs = fut.result()
+            sites.setdefault(entry["site"], SpeedSummary()).merge(summary, lanes=entry["site"] is not None)
+            total.merge(summary, lanes=False)
+            clips.append({"path": entry["path"], "site": entry["site"], "cars": ncars, "seconds": secs})
+            if log is not None:
+                log.write("[%d/%d] %s: %d cars in %.2fs\n" % (k + 1, len(entries), entry["path"], ncars, secs))
+    if log is not None:
+        log.write("%d clips in %.2fs\n" % (len(entries), time.perf_counter() - t0))
+
+    result = {
+        "clips": clips,
+        "sites": {str(site): {"average_speed": s.average_speed(), "lane_speeds": s.lane_speeds(),
+                            "cars_with_speed": s.count}
+                  for site, s in sites.items()},
+        "average_speed": total.average_speed(),
+        "cars_with_speed": total.count,
+    }
+    if out_dir is not None:
+        with open(os.path.join(out_dir, 'summary.json'), 'w') as f:
+            json.dump(result, f, indent = 4, default=json_default)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='batch traffic analytics over serialized tracker outputs')
+    parser.add_argument('source', help='directory of .npz/.json tracker outputs or a manifest file')
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--dist-per-pixel', type=float, required=True)
+    parser.add_argument('--out', default=None, help='directory for per-clip ndjson and summary.json')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--reg-method', default='ols', choices=sorted(REGRESSION_METHODS))
+    parser.add_argument('--cache-dir', default='lane_cache')
+    args = parser.parse_args()
+
+    result = batch_analytics(args.source, args.fps, args.dist_per_pixel, args.out, args.workers,
+                             args.reg_method, args.cache_dir)
+    for site, s in result["sites"].items():
+        print("Site", site, ":", s["cars_with_speed"], "cars with a speed, average speed", s["average_speed"], "m/s")
+        for l, speed in s["lane_speeds"].items():
+            print("  Lane", l, "speed:", speed, "m/s")
+    print("Average speed:", result["average_speed"], "m/s over", result["cars_with_speed"], "cars")
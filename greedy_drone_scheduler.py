@@ -4,33 +4,144 @@
 #-----------------------------------------#
 
 import numpy as np
+import heapq
+import time
+import itertools
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+# Fleet state kept as contiguous arrays, one row per drone, so movement, battery
+# drain and charging are applied to every drone with a handful of array ops.
+# states: 'a' active (flying to / hovering at a site), 'r' returning, 'c' charging
+class Fleet:
+    def __init__(self, capacity=16):
+        self.n = 0
+        self.names = []
+        self.pos = np.zeros((capacity, 2))
+        self.goal = np.zeros((capacity, 2))
+        self.batt = np.zeros(capacity)
+        self.state = np.full(capacity, 'c', dtype='<U1')
+
+    def add(self, name, batt, curr_loc, goal_loc, state):
+        if self.n == len(self.batt):
+            cap = 2*len(self.batt)
+            self.pos = np.resize(self.pos, (cap, 2))
+            self.goal = np.resize(self.goal, (cap, 2))
+            self.batt = np.resize(self.batt, cap)
+            self.state = np.resize(self.state, cap)
+        i = self.n
+        self.names.append(name)
+        self.pos[i] = curr_loc
+        self.goal[i] = goal_loc
+        self.batt[i] = batt
+        self.state[i] = state
+        self.n += 1
+        return i
+
+    def drones(self):
+        return [Drone.view(self, i) for i in range(self.n)]
+
+    def dist(self):
+        d = self.goal[:self.n] - self.pos[:self.n]
+        return np.hypot(d[:, 0], d[:, 1])
+
+    # one tick for the whole fleet: flying drones move rate towards their goal
+    # (snapping once within eps), returning drones that reach it start charging,
+    # active/returning drones lose dbatt and charging drones gain cbatt
+    def step(self, rate, dbatt, cbatt, eps=0.3):
+        n = self.n
+        pos = self.pos[:n]
+        goal = self.goal[:n]
+        state = self.state[:n]
+        batt = self.batt[:n]
+        flying = state != 'c'
+        delta = goal - pos
+        far = flying & np.any(np.abs(delta) > eps, axis=1)
+        d = np.hypot(delta[far, 0], delta[far, 1])
+        pos[far] += delta[far] * (rate/d)[:, None]
+        near = flying & ~far
+        pos[near] = goal[near]
+        state[near & (state == 'r')] = 'c'
+        batt[flying] -= dbatt
+        charging = state == 'c'
+        batt[charging] = np.minimum(batt[charging] + cbatt, 100)
+        return far
+
+# lightweight view of one fleet row; Drone(...) still works on its own and
+# then gets a fleet of one
 class Drone:
-    def __init__(self, name, batt, curr_loc, goal_loc, state):
-        self.name = name
-        self.batt = batt
-        self.curr_loc = curr_loc
-        self.goal_loc = goal_loc
-        self.state = state
+    __slots__ = ('fleet', 'idx')
+
+    def __init__(self, name, batt, curr_loc, goal_loc, state, fleet=None):
+        self.fleet = Fleet(1) if fleet is None else fleet
+        self.idx = self.fleet.add(name, batt, curr_loc, goal_loc, state)
+
+    @classmethod
+    def view(cls, fleet, idx):
+        dro = cls.__new__(cls)
+        dro.fleet = fleet
+        dro.idx = idx
+        return dro
+
+    @property
+    def name(self):
+        return self.fleet.names[self.idx]
+
+    @property
+    def batt(self):
+        return self.fleet.batt[self.idx]
+
+    @batt.setter
+    def batt(self, value):
+        self.fleet.batt[self.idx] = value
+
+    # positions are copied out so a Drone behaves like a value, writes go
+    # through the setters
+    @property
+    def curr_loc(self):
+        return self.fleet.pos[self.idx].copy()
+
+    @curr_loc.setter
+    def curr_loc(self, value):
+        self.fleet.pos[self.idx] = value
+
+    @property
+    def goal_loc(self):
+        return self.fleet.goal[self.idx].copy()
+
+    @goal_loc.setter
+    def goal_loc(self, value):
+        self.fleet.goal[self.idx] = value
+
+    @property
+    def state(self):
+        return str(self.fleet.state[self.idx])
+
+    @state.setter
+    def state(self, value):
+        self.fleet.state[self.idx] = value
         
     def __repr__(self):
         return str(self.name) + " - Battery: " + str(self.batt) + " Current Location: " + str(self.curr_loc) + " Goal Location: " + str(self.goal_loc) + " State: " + self.state
     
     def dist(self):
-        return ((self.goal_loc[0]-self.curr_loc[0])**2 + (self.goal_loc[1]-self.curr_loc[1])**2)**0.5
+        d = self.goal_loc - self.curr_loc
+        return np.hypot(d[0], d[1])
 
     def vec(self, rate):
-        return np.asarray(((self.goal_loc[0]-self.curr_loc[0])*rate/self.dist(), (self.goal_loc[1]-self.curr_loc[1])*rate/self.dist()))
+        d = self.goal_loc - self.curr_loc
+        return d*(rate/np.hypot(d[0], d[1]))
 
 def simulation(numdrones, numlocs, start, rate, dbatt, cbatt, numiters):
     airspace = []
+    fleet = Fleet(max(16, numdrones))
     dronecount = numdrones
     locs = [(0,1), (1,0), (0,3), (3,0), (1,2), (2,1), (2,3), (3,2)] #define locations for each drone on the grid
 
     for i in range(numlocs):
-        airspace.append(Drone(str(i+1), 100, start, np.asarray(locs[i]), 'a'))
+        airspace.append(Drone(str(i+1), 100, start, np.asarray(locs[i]), 'a', fleet))
         
     for i in range(numdrones-numlocs):
-        airspace.append(Drone(str(i+numlocs+1), 100, start, np.asarray((0,0)), 'c')) #unused drones
+        airspace.append(Drone(str(i+numlocs+1), 100, start, np.asarray((0,0)), 'c', fleet)) #unused drones
     
     for i in range(numiters):
         print('\nIteration: ' + str(i))
@@ -58,7 +169,7 @@ def simulation(numdrones, numlocs, start, rate, dbatt, cbatt, numiters):
                         max_charged.state = 'a'
                     else:
                         dronecount += 1
-                        airspace.append(Drone(str(dronecount), 100, start, dro.goal_loc, 'a')) #assuming infinite supply of drones
+                        airspace.append(Drone(str(dronecount), 100, start, dro.goal_loc, 'a', fleet)) #assuming infinite supply of drones
 
                     dro.goal_loc = np.asarray((0,0))
                     dro.state = 'r'
@@ -83,4 +194,313 @@ def simulation(numdrones, numlocs, start, rate, dbatt, cbatt, numiters):
                 
         print(airspace)
 
-simulation(14, 8, (0,0), 1, 4, 1.7, 10) 
+DEFAULT_LOCS = [(0,1), (1,0), (0,3), (3,0), (1,2), (2,1), (2,3), (3,2)]
+
+# the default grid for up to 8 sites, otherwise sites spread uniformly over a
+# square of side extent (same seed, same sites)
+def generate_locs(numlocs, extent=4, seed=0):
+    if numlocs <= len(DEFAULT_LOCS):
+        return DEFAULT_LOCS[:numlocs]
+    rng = np.random.default_rng(seed)
+    return [tuple(l) for l in rng.uniform(0, extent, (numlocs, 2))]
+
+# nearest depots for every site, precomputed once since neither moves. a lookup
+# walks depots nearest-first and can stop as soon as the travel time alone is
+# worse than the best gap found, so it does not scan all depots or drones
+class DepotIndex:
+    def __init__(self, depots, sites, k=8):
+        self.depots = np.asarray(depots, dtype=float).reshape(-1, 2)
+        self.sites = np.asarray(sites, dtype=float).reshape(-1, 2)
+        self.k = min(k, len(self.depots))
+        self.order = np.zeros((len(self.sites), self.k), dtype=np.int64)
+        self.dist = np.zeros((len(self.sites), self.k))
+        for lo in range(0, len(self.sites), 1024):
+            d = np.linalg.norm(self.sites[lo:lo+1024, None] - self.depots[None], axis=2)
+            near = np.argpartition(d, self.k - 1, axis=1)[:, :self.k]
+            nd = np.take_along_axis(d, near, axis=1)
+            srt = np.argsort(nd, axis=1)
+            self.order[lo:lo+1024] = np.take_along_axis(near, srt, axis=1)
+            self.dist[lo:lo+1024] = np.take_along_axis(nd, srt, axis=1)
+
+    def nearest(self, site):
+        return self.order[site, 0], self.dist[site, 0]
+
+    # (depot, distance) pairs, nearest first; falls back to every depot past k
+    def walk(self, site):
+        for j, d in zip(self.order[site], self.dist[site]):
+            yield j, d
+        if self.k < len(self.depots):
+            d = np.linalg.norm(self.depots - self.sites[site], axis=1)
+            for j in np.argsort(d)[self.k:]:
+                yield j, d[j]
+
+# battery a charged drone needs before it is sent d away to a site with the given
+# return reserve: the flight out, the reserve, and ready_frac of the hover time a
+# full battery would leave on top. None if even a full battery cannot cover it
+def ready_battery(d, reserve, rate, dbatt, ready_frac):
+    need = d*dbatt/rate + reserve
+    if need > 100:
+        return None
+    return need + ready_frac*(100 - need)
+
+# Event-driven version of simulation. Instead of stepping every drone each tick,
+# arrival, swap and return times are solved analytically from rate and dbatt and
+# kept in a priority queue. Times are in simulation ticks.
+# The swap threshold is the same greedy rule: leave once the battery drops below
+# 2*dist*dbatt/rate, dist being the distance from the site back to its depot.
+# Drones charge at depots (just start unless depots is given). Charging drones sit
+# in one heap per depot keyed on their battery extrapolated back to t=0 (all charge
+# at cbatt, so the order never changes), so each depot's best drone is O(log n).
+# The replacement is the one with the smallest coverage gap, travel time plus the
+# time it still needs to charge, found by walking depots nearest-first (DepotIndex).
+# A drone is ready once it can fly out, keep the return reserve and still hover for
+# ready_frac of what a full battery would give at that site, so replacements do not
+# arrive only to turn straight around. With spawn=True (infinite supply, as before)
+# a new drone is added at the nearest depot whenever no charged drone is ready.
+# Otherwise a site with no drone at any depot waits in a pending queue that is
+# served, oldest first, whenever a drone starts charging.
+def event_simulation(numdrones, numlocs, start, rate, dbatt, cbatt, horizon, locs=None, verbose=True,
+                     depots=None, spawn=True, ready_frac=0.5):
+    locs = generate_locs(numlocs) if locs is None else locs
+    depots = [start] if depots is None else depots
+    depot_locs = [np.asarray(d, dtype=float) for d in depots]
+    sites = [np.asarray(l, dtype=float) for l in locs[:numlocs]]
+    index = DepotIndex(depot_locs, sites)
+    home = [index.nearest(i) for i in range(len(sites))] # (depot, distance) each site returns to
+
+    events = [] # (time, seq, kind, drone, site, distance flown)
+    charged = [[] for _ in depots] # per depot (-(battery at t=0), seq, drone)
+    charge_t = {} # drone name -> (time charging started, battery then)
+    coverage = [[] for _ in sites] # per site list of (arrive, leave) intervals
+    pending = [] # sites waiting for a drone, oldest first
+    airspace = []
+    fleet = Fleet(max(16, numdrones))
+    seq = [0]
+    spawned = [0]
+
+    def push(t, kind, dro, site, d):
+        seq[0] += 1
+        heapq.heappush(events, (t, seq[0], kind, dro, site, d))
+
+    def launch(t, dro, site, d):
+        dro.goal_loc = sites[site]
+        dro.state = 'a'
+        push(t + d/rate, 'arrive', dro, site, d)
+
+    def charge(t, dro, depot):
+        dro.curr_loc = depot_locs[depot]
+        dro.goal_loc = depot_locs[depot]
+        dro.state = 'c'
+        charge_t[dro.name] = (t, dro.batt)
+        seq[0] += 1
+        heapq.heappush(charged[depot], (-(dro.batt - cbatt*t), seq[0], dro))
+        for site in list(pending):
+            repl = dispatch(t, site)
+            if repl is None:
+                break
+            pending.remove(site)
+            if verbose:
+                print('t=%.2f Drone %s sent to waiting site %s' % (t, repl.name, sites[site]))
+
+    def battery(t, dro):
+        t0, b0 = charge_t[dro.name]
+        return min(100, b0 + cbatt*(t - t0))
+
+    # replacement with the smallest travel + charge wait, as (gap, wait, depot, distance)
+    def best_replacement(t, site):
+        reserve = 2*home[site][1]*dbatt/rate
+        best = None
+        for j, d in index.walk(site):
+            if best is not None and d/rate >= best[0]:
+                break
+            if not charged[j]:
+                continue
+            need = ready_battery(d, reserve, rate, dbatt, ready_frac)
+            if need is None:
+                continue
+            wait = max(0, need - battery(t, charged[j][0][2]))/cbatt
+            if spawn and wait > 0:
+                continue
+            gap = d/rate + wait
+            if best is None or gap < best[0]:
+                best = (gap, wait, j, d)
+        return best
+
+    # send the best replacement to site, None if no depot has a drone
+    def dispatch(t, site):
+        best = best_replacement(t, site)
+        if best is None:
+            return None
+        gap, wait, j, dj = best
+        repl = heapq.heappop(charged[j])[2]
+        repl.batt = battery(t + wait, repl)
+        launch(t + wait, repl, site, dj)
+        return repl
+
+    for i in range(numlocs):
+        j, d = home[i]
+        dro = Drone(str(i+1), 100, depot_locs[j], depot_locs[j], 'a', fleet)
+        airspace.append(dro)
+        launch(0, dro, i, d)
+    # every site gets a drone at t=0, those beyond numdrones count as spawned
+    spawned[0] += max(0, numlocs - numdrones)
+    for i in range(numdrones-numlocs):
+        j = i % len(depots)
+        dro = Drone(str(i+numlocs+1), 100, depot_locs[j], depot_locs[j], 'c', fleet)
+        airspace.append(dro)
+        charge(0, dro, j)
+    dronecount = len(airspace)
+
+    t = 0
+    while events and events[0][0] <= horizon:
+        t, _, kind, dro, site, d = heapq.heappop(events)
+        if kind == 'arrive':
+            dro.batt -= d/rate*dbatt
+            dro.curr_loc = sites[site]
+            coverage[site].append([t, horizon])
+            reserve = 2*home[site][1]*dbatt/rate
+            push(t + max(0, dro.batt - reserve)/dbatt, 'swap', dro, site, d)
+            if verbose:
+                print('t=%.2f Drone %s arrived at %s' % (t, dro.name, dro.curr_loc))
+        elif kind == 'swap':
+            # battery drained while hovering since arrival
+            dro.batt = min(dro.batt, 2*home[site][1]*dbatt/rate)
+            coverage[site][-1][1] = t
+            repl = dispatch(t, site)
+            if repl is None and spawn:
+                j, dj = home[site]
+                dronecount += 1
+                spawned[0] += 1
+                repl = Drone(str(dronecount), 100, depot_locs[j], depot_locs[j], 'a', fleet) #assuming infinite supply of drones
+                airspace.append(repl)
+                launch(t, repl, site, dj)
+            elif repl is None:
+                pending.append(site)
+            dro.goal_loc = depot_locs[home[site][0]]
+            dro.state = 'r'
+            push(t + home[site][1]/rate, 'home', dro, site, home[site][1])
+            if verbose:
+                print('t=%.2f Drone %s is turning around from %s, replaced by %s' % (t, dro.name, dro.curr_loc, repl.name if repl else None))
+        else:
+            dro.batt -= d/rate*dbatt
+            charge(t, dro, home[site][0])
+            if verbose:
+                print('t=%.2f Drone %s is charging' % (t, dro.name))
+
+    for dro in airspace:
+        if dro.state == 'c':
+            dro.batt = battery(horizon, dro)
+    return {'airspace': airspace, 'coverage': coverage, 'spawned': spawned[0], 'time': t}
+
+# Tick-based greedy policy on the array-backed fleet: each iteration only loops
+# over the drones that have to swap, then moves, drains and charges the whole
+# fleet in one Fleet.step. Swaps use the readiness rule of event_simulation
+# (ready_battery) with the single depot at start: the fullest charging drone goes
+# if it holds enough, otherwise a new one is added.
+def fleet_simulation(numdrones, numlocs, start, rate, dbatt, cbatt, numiters, locs=None, verbose=True,
+                     ready_frac=0.5):
+    locs = generate_locs(numlocs) if locs is None else locs
+    start = np.asarray(start, dtype=float)
+    fleet = Fleet(max(16, numdrones))
+    spawned = 0
+
+    for i in range(numlocs):
+        fleet.add(str(i+1), 100, start, locs[i], 'a')
+    for i in range(numdrones-numlocs):
+        fleet.add(str(i+numlocs+1), 100, start, start, 'c') #unused drones
+
+    for i in range(numiters):
+        n = fleet.n
+        home = fleet.pos[:n] - start
+        reserve = 2*np.hypot(home[:, 0], home[:, 1])*dbatt/rate
+        dying = np.flatnonzero((fleet.state[:n] == 'a') & (fleet.batt[:n] < reserve))
+        for k in dying:
+            site = fleet.goal[k].copy()
+            d = np.hypot(*(site - start))
+            need = ready_battery(d, 2*d*dbatt/rate, rate, dbatt, ready_frac)
+            charging = np.flatnonzero(fleet.state[:fleet.n] == 'c')
+            best = charging[np.argmax(fleet.batt[charging])] if len(charging) else None
+            if best is None or need is None or fleet.batt[best] < need:
+                spawned += 1
+                best = fleet.add(str(fleet.n+1), 100, start, start, 'c') #assuming infinite supply of drones
+            fleet.goal[best] = site
+            fleet.state[best] = 'a'
+            fleet.goal[k] = start
+            fleet.state[k] = 'r'
+            if verbose:
+                print('Drone ' + fleet.names[k] + ' is turning around from ' + str(fleet.pos[k]) + ', replaced by ' + fleet.names[best])
+        fleet.step(rate, dbatt, cbatt)
+        if verbose:
+            print('\nIteration: ' + str(i))
+            print(fleet.drones())
+
+    return {'fleet': fleet, 'spawned': spawned}
+
+# coverage metrics for one event_simulation run: fraction of the horizon each
+# site had a drone on it, and the gaps between consecutive visits
+def coverage_metrics(coverage, horizon):
+    fractions = np.zeros(len(coverage))
+    gaps = []
+    for i, intervals in enumerate(coverage):
+        iv = np.asarray(intervals, dtype=float).reshape(-1, 2)
+        fractions[i] = np.sum(iv[:, 1] - iv[:, 0]) / horizon
+        gaps.append(iv[1:, 0] - iv[:-1, 1])
+    gaps = np.concatenate(gaps) if gaps else np.zeros(0)
+    return fractions, gaps
+
+SWEEP_FIELDS = [('numdrones', 'i4'), ('numlocs', 'i4'), ('rate', 'f8'), ('dbatt', 'f8'), ('cbatt', 'f8'),
+                ('horizon', 'f8'), ('coverage_mean', 'f8'), ('coverage_min', 'f8'), ('gap_count', 'i4'),
+                ('gap_mean', 'f8'), ('gap_max', 'f8'), ('spawned', 'i4'), ('wall_time', 'f8')]
+
+def sweep_run(params):
+    numdrones, numlocs, rate, dbatt, cbatt, horizon = params
+    t0 = time.perf_counter()
+    res = event_simulation(numdrones, numlocs, (0,0), rate, dbatt, cbatt, horizon,
+                           locs=generate_locs(numlocs), verbose=False)
+    wall = time.perf_counter() - t0
+    fractions, gaps = coverage_metrics(res['coverage'], horizon)
+    row = (numdrones, numlocs, rate, dbatt, cbatt, horizon, fractions.mean(), fractions.min(), len(gaps),
+           gaps.mean() if len(gaps) else 0.0, gaps.max() if len(gaps) else 0.0, res['spawned'], wall)
+    return row, fractions
+
+# runs event_simulation (no printing) for every combination in the grid on a
+# process pool. returns a structured array with one row per run, queryable with
+# boolean masks (e.g. table[table['spawned'] == 0]), and the per-site coverage
+# fractions of each run. points with fewer drones than sites run too: every site
+# still gets a drone at t=0 and the drones beyond numdrones are counted in
+# 'spawned' along with the ones added later
+def sweep(numdrones, numlocs, rate, dbatt, cbatt, horizon, workers=None):
+    grid = list(itertools.product(numdrones, numlocs, rate, dbatt, cbatt, [horizon]))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(sweep_run, grid, chunksize=max(1, len(grid)//64)))
+    table = np.array([r[0] for r in results], dtype=SWEEP_FIELDS)
+    return table, [r[1] for r in results]
+
+def save_sweep(fname, table, site_coverage):
+    offsets = np.cumsum([0] + [len(c) for c in site_coverage])
+    coverage = np.concatenate(site_coverage) if site_coverage else np.zeros(0)
+    np.savez(fname, table=table, site_coverage=coverage, site_offsets=offsets)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='greedy drone scheduler; runs the demo unless --sweep is given')
+    parser.add_argument('--sweep', action='store_true', help='run a parameter sweep instead of the demo')
+    parser.add_argument('--drones', type=int, nargs='+', default=[14])
+    parser.add_argument('--sites', type=int, nargs='+', default=[8])
+    parser.add_argument('--rate', type=float, nargs='+', default=[1])
+    parser.add_argument('--dbatt', type=float, nargs='+', default=[4])
+    parser.add_argument('--cbatt', type=float, nargs='+', default=[1.7])
+    parser.add_argument('--horizon', type=float, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=None, help='.npz file for the results table')
+    args = parser.parse_args()
+
+    if not args.sweep:
+        simulation(14, 8, (0,0), 1, 4, 1.7, 10)
+    else:
+        table, site_coverage = sweep(args.drones, args.sites, args.rate, args.dbatt, args.cbatt, args.horizon,
+                                     args.workers)
+        print(' '.join(name for name, _ in SWEEP_FIELDS))
+        for row in table:
+            print(' '.join('%g' % v for v in row))
+        if args.out is not None:
+            save_sweep(args.out, table, site_coverage) 
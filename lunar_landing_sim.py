@@ -4,69 +4,153 @@
 
 from PIL import Image, ImageDraw
 import numpy as np
-import cv2
-import image_slicer
 import os
+import sys
 import math
-from keras.preprocessing.image import save_img
+import time
+import shutil
+import tempfile
+import itertools
+import argparse
+import json
+import contextlib
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
-from upsampling_main import just_bilinear, PIL_bilinear , PIL_bicubic, PIL_lanczos
-from ISR.models import RDN, RRDN
+from proc_stats import reset_peak_rss, peak_rss
+
+# model backends (torch, ISR/TensorFlow, the classical upsamplers) are imported
+# by the backend that needs them on first use, see SR_BACKENDS
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 w = 0
 h = 0
 
-def next_trajectory(image_dir, num_tiles, split_dir, dist_weight):
-    files = []
-    percentages = []
-    distances = []
-    coords = []
-    dist_dict = {}
+YOLO_DIR = '../low_alt_nn/obj_det/yolov5'
+YOLO_WEIGHTS = YOLO_DIR + '/runs/train/iter3/weights/best.pt'
+BOX_COLOR = (255,56,56) #bbox color
+
+# same grid as image_slicer.slice(f, num_tiles): ceil(sqrt(n)) columns, the
+# remainder on the right/bottom edge is dropped
+def calc_columns_rows(num_tiles):
+    columns = int(math.ceil(math.sqrt(num_tiles)))
+    rows = int(math.ceil(num_tiles / float(columns)))
+    return columns, rows
+
+def load_rgb(f):
+    return np.asarray(Image.open(f).convert('RGB'))
+
+# in-memory replacement for image_slicer tiles: tiles[r, c] is a strided view into
+# the image (no copies, nothing written to disk). names follow image_slicer's
+# img_RR_CC.png (1-based) so they still line up with dist_dict keys, and offsets
+# holds each tile's (x, y) position relative to the center tile in pixels
+class TileGrid:
+    def __init__(self, image, num_tiles, prefix='img'):
+        self.image = image
+        self.cols, self.rows = calc_columns_rows(num_tiles)
+        self.h = image.shape[0] // self.rows
+        self.w = image.shape[1] // self.cols
+        s0, s1 = image.strides[:2]
+        self.tiles = np.lib.stride_tricks.as_strided(
+            image, (self.rows, self.cols, self.h, self.w) + image.shape[2:],
+            (self.h*s0, self.w*s1, s0, s1) + image.strides[2:], writeable=False)
+        r, c = np.divmod(np.arange(self.rows*self.cols), self.cols)
+        self.names = ['%s_%02d_%02d.png' % (prefix, i+1, j+1) for i, j in zip(r, c)]
+        center = math.ceil(math.sqrt(num_tiles)/2)
+        self.offsets = np.column_stack(((c+1-center)*self.w, (center-(r+1))*self.h))
+
+    def __len__(self):
+        return len(self.names)
+
+    def tile(self, i):
+        return self.tiles[i // self.cols, i % self.cols]
+
+    # the part of the image covered by tiles (what image_slicer.join gives back)
+    def covered(self):
+        return self.image[:self.rows*self.h, :self.cols*self.w]
+
+# hazard mask of a frame plus its summed-area table, built once per frame. the
+# hazard pixel count of any rectangle is then four lookups, so coverage for a
+# whole tile grid of any size is one vectorized step
+class HazardIndex:
+    def __init__(self, mask):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.sat = np.zeros((self.mask.shape[0]+1, self.mask.shape[1]+1), dtype=np.int64)
+        np.cumsum(np.cumsum(self.mask, axis=0), axis=1, out=self.sat[1:, 1:])
+
+    @classmethod
+    def from_image(cls, image, color=BOX_COLOR):
+        return cls((image == np.asarray(color)).all(-1))
+
+    # filled boxes (x0, y0, x1, y1), painted with a 2d difference array
+    @classmethod
+    def from_boxes(cls, shape, boxes):
+        h, w = shape[:2]
+        diff = np.zeros((h+1, w+1), dtype=np.int32)
+        if len(boxes):
+            b = np.asarray(boxes)[:, :4].round().astype(np.int64)
+            x0, x1 = np.clip(b[:, 0], 0, w), np.clip(b[:, 2], 0, w)
+            y0, y1 = np.clip(b[:, 1], 0, h), np.clip(b[:, 3], 0, h)
+            np.add.at(diff, (y0, x0), 1)
+            np.add.at(diff, (y0, x1), -1)
+            np.add.at(diff, (y1, x0), -1)
+            np.add.at(diff, (y1, x1), 1)
+        return cls(np.cumsum(np.cumsum(diff, axis=0), axis=1)[:h, :w] > 0)
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    # hazard pixels in [y0, y1) x [x0, x1), works elementwise on arrays
+    def count(self, y0, x0, y1, x1):
+        sat = self.sat
+        return sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+
+    # percentage of each tile covered, flattened in tile (name) order
+    def grid_coverage(self, grid):
+        ys = np.arange(grid.rows + 1)*grid.h
+        xs = np.arange(grid.cols + 1)*grid.w
+        counts = self.count(ys[:-1, None], xs[None, :-1], ys[1:, None], xs[None, 1:])
+        return counts.ravel()*100.0/(grid.h*grid.w)
+
+    # weighted distance/coverage score of every tile for one grid size
+    def score_map(self, num_tiles, dist_weight):
+        grid = TileGrid(self.mask, num_tiles)
+        distances = np.hypot(grid.offsets[:,0], grid.offsets[:,1])
+        percentages = self.grid_coverage(grid)
+        return grid, percentages, distances*dist_weight + percentages*(1-dist_weight)
+
+    # score maps for several candidate grid sizes, keyed by num_tiles
+    def score_maps(self, num_tiles_list, dist_weight):
+        return {n: self.score_map(n, dist_weight) for n in num_tiles_list}
+
+# image may be a path, an RGB array or a prebuilt HazardIndex
+def next_trajectory(image, num_tiles, dist_weight):
     center_thres = False
-    center_file = None
     no_move = False
 
-    tiles = image_slicer.slice(image_dir, num_tiles, save=False)
-    image_slicer.save_tiles(tiles, directory=split_dir, prefix='img')
-    
-    for f in os.listdir(split_dir):
-        if f.split('.')[1] in ["png", "jpg", "jpeg"]:
-            files.append(f)
-            im = Image.open(split_dir+f).convert('RGB')
-            na = np.array(im)
-            red = np.array([255,56,56]) #bbox color
-            red_dot = np.dot(red.astype(np.uint32),[1,256,65536]) 
-            dott = np.dot(na.astype(np.uint32),[1,256,65536]) 
-            colors, count = np.unique(dott, return_counts=True)
-            idx = np.where(colors == red_dot)
-            w,h = im.size
-            percent = count[idx]*100.0/(w*h)
-            percentages.append(percent[0] if len(percent) > 0 else 0)
-
-            split_fn = f.split('_')
-            r = split_fn[1]
-            c = split_fn[2].split('.')[0]
-            center = math.ceil(math.sqrt(num_tiles)/2)
-            new_x = (int(c)-center)*w
-            new_y = (center-int(r))*h
-            coords.append(np.array([new_x, new_y]))
-            distances.append(math.sqrt(new_x**2 + new_y**2)) 
-            if new_x == 0 and new_y == 0: #in center square
-                center_file = f
-                if np.array_equal(na[h//2][w//2], red) and percent > 20: #crater/obstable in center of image and more than 20% of image is covered
-                    center_thres = True                
-                    print('Crater in center, therefore must relocate')
-                elif len(percent) > 0 and percent< 20: #crater not in center but box has less thatn 20% covered area
-                   no_move = True 
-
-    weighted = np.array(distances)*dist_weight + np.array(percentages)*(1-dist_weight)
+    if not isinstance(image, HazardIndex):
+        image = HazardIndex.from_image(load_rgb(image) if isinstance(image, str) else image)
+    grid, percentages, weighted = image.score_map(num_tiles, dist_weight)
+    coords = grid.offsets
+    files = grid.names
+
+    center_idx = np.flatnonzero((coords[:,0] == 0) & (coords[:,1] == 0))[0] #center square
+    center_file = files[center_idx]
+    percent = percentages[center_idx]
+    r, c = divmod(center_idx, grid.cols)
+    if image.mask[r*grid.h + grid.h//2, c*grid.w + grid.w//2] and percent > 20: #crater/obstable in center of image and more than 20% of image is covered
+        center_thres = True
+        print('Crater in center, therefore must relocate')
+    elif 0 < percent < 20: #crater not in center but box has less thatn 20% covered area
+        no_move = True
+
     min_idx = np.where(weighted == min(weighted))[0][0]
     min_file = files[min_idx]
-    for i in range(len(weighted)):
-        dist_dict[files[i]] = weighted[i]
-    
+    dist_dict = dict(zip(files, weighted))
+
     if center_thres and min_file == center_file:
         sort_weight = np.sort(weighted)
         if sort_weight[1] - sort_weight[0] < 0.3*sort_weight[0]: #threshold for closeness of values to switch
@@ -77,8 +161,68 @@ def next_trajectory(image_dir, num_tiles, split_dir, dist_weight):
     min_coord = coords[min_idx]
     return min_coord, min_file, dist_dict
 
-def draw_grid(f, step_count, min_c):
-    image = Image.open(f).convert('RGB')
+# detectors load their model once and map an RGB array to an (N, 4) array of
+# x0, y0, x1, y1 boxes, so hazards come straight from the model output
+
+# yolov5 from the local checkout, same settings as the old detect.py calls
+class YoloDetector:
+    def __init__(self, weights=YOLO_WEIGHTS, img_size=350, conf=0.5, repo=YOLO_DIR):
+        import torch
+        self.model = torch.hub.load(repo, 'custom', path=weights, source='local')
+        self.model.conf = conf
+        self.img_size = img_size
+
+    def detect(self, image):
+        pred = self.model(image, size=self.img_size).xyxy[0]
+        return pred[:, :4].cpu().numpy()
+
+# deterministic CPU stand-in for testing and benchmarking without the weights:
+# boxes every cell whose mean brightness is k standard deviations below the
+# frame's (crater shadows)
+class StubDetector:
+    def __init__(self, cell=16, k=1.5):
+        self.cell = cell
+        self.k = k
+
+    def detect(self, image):
+        gray = image.mean(-1) if image.ndim == 3 else image
+        n = self.cell
+        ch, cw = gray.shape[0]//n, gray.shape[1]//n
+        cells = gray[:ch*n, :cw*n].reshape(ch, n, cw, n).mean(axis=(1,3))
+        ys, xs = np.nonzero(cells < cells.mean() - self.k*cells.std())
+        return np.column_stack((xs*n, ys*n, (xs+1)*n, (ys+1)*n))
+
+DETECTORS = {
+    'yolo': YoloDetector,
+    'stub': StubDetector,
+}
+
+DETECTOR_MODELS = {}
+
+# detector by name, loaded once per process and reused afterwards
+def get_detector(detector):
+    if not isinstance(detector, str):
+        return detector
+    if detector not in DETECTOR_MODELS:
+        DETECTOR_MODELS[detector] = DETECTORS[detector]()
+    return DETECTOR_MODELS[detector]
+
+# boxes drawn onto a copy of the frame, filled like edit_detect.py or as
+# outlines like detect.py
+def draw_boxes(image, boxes, fill=False, color=BOX_COLOR, width=3):
+    im = Image.fromarray(image).convert('RGB')
+    draw = ImageDraw.Draw(im)
+    for x0, y0, x1, y1 in np.asarray(boxes)[:, :4].tolist():
+        if fill:
+            draw.rectangle([x0, y0, x1-1, y1-1], fill=color)
+        else:
+            draw.rectangle([x0, y0, x1-1, y1-1], outline=color, width=width)
+    return np.asarray(im)
+
+# image is the already loaded frame, otherwise f is opened. the grid image is
+# saved to out_dir and previewed with imgcat when show is set
+def draw_grid(f, step_count, min_c, image=None, out_dir='testing/grid/', show=True):
+    image = Image.open(f).convert('RGB') if image is None else Image.fromarray(image).convert('RGB')
     draw = ImageDraw.Draw(image)
 
     w = image.width
@@ -105,37 +249,33 @@ def draw_grid(f, step_count, min_c):
         draw.ellipse([(w//2+min_c[0]-10, h//2-min_c[1]-10), (w//2+min_c[0]+10, h//2-min_c[1]+10)], outline= 'red', fill='red')
 
     del draw
-    filename = "grid_"+f.split('/')[-1]
-    image.save('testing/grid/' + filename)
-    os.system('imgcat testing/grid/' + filename)
+    filename = os.path.join(out_dir, "grid_"+f.split('/')[-1])
+    image.save(filename)
+    if show:
+        os.system('imgcat ' + filename)
     return (w,h)
 
-def mask_weights(iter_num, dist_dict, img_dir, split_dir, num_tiles):
-    tiles = image_slicer.slice(img_dir, num_tiles, save=False)
-    image_slicer.save_tiles(tiles, directory=split_dir, prefix='img')
-    
-    def hex2rgb(h):  # rgb order (PIL)
-        return tuple(int(h[1 + i:1 + i + 2], 16) for i in (0, 2, 4))
-
-    c = hex2rgb('#2C99A8')
-    ignore_color = (c[2], c[1], c[0])
-    for tile in tiles:
-        filename = tile.filename.split('/')[-1]
-        image = cv2.imread(split_dir+filename)
-        
-        red_img  = np.full(image.shape, (0,0,255), np.uint8)
-        w = dist_dict[filename]/100
-
-        mask = (image!=ignore_color).any(-1)
-        out = image.copy()
-        out[mask] = image[mask] * (1-w) + red_img[mask] * w
-        cv2.imwrite(split_dir+filename, out)
-        
-        #fused_img  = cv2.addWeighted(image, 1-w, red_img, w, 0)
-        #cv2.imwrite(split_dir+filename, fused_img)
-        tile.image = Image.open(split_dir+filename)
-    img = image_slicer.join(tiles)
-    img.save('testing/joint/' + iter_num + '_joined.png')
+def hex2rgb(h):  # rgb order (PIL)
+    return tuple(int(h[1 + i:1 + i + 2], 16) for i in (0, 2, 4))
+
+# red overlay with each tile's weight from dist_dict as alpha, blended over the
+# whole covered frame at once: the tile weights broadcast over a
+# (rows, h, cols, w) view of the output, no per-tile copies
+def weight_overlay(dist_dict, image, num_tiles, ignore_color=hex2rgb('#2C99A8'), color=(255,0,0)):
+    grid = TileGrid(image, num_tiles)
+    out = grid.covered().copy()
+    alpha = np.array([dist_dict[name] for name in grid.names], dtype=np.float32)/100
+    alpha = alpha.reshape(grid.rows, 1, grid.cols, 1, 1)
+    o = out.reshape(grid.rows, grid.h, grid.cols, grid.w, -1)
+    mask = (o != ignore_color).any(-1, keepdims=True)
+    np.copyto(o, o*(1-alpha) + np.asarray(color, dtype=np.float32)*alpha, casting='unsafe', where=mask)
+    return out
+
+def mask_weights(iter_num, dist_dict, image, num_tiles, out_dir='testing/joint/'):
+    image = load_rgb(image) if isinstance(image, str) else image
+    filename = os.path.join(out_dir, iter_num + '_joined.png')
+    Image.fromarray(weight_overlay(dist_dict, image, num_tiles)).save(filename)
+    return filename
 
 def cropping(w,h,move):
     t = move[1]-h//2
@@ -156,76 +296,622 @@ def cropping(w,h,move):
         r = 2*w-1
     return np.array([t,b,l,r])
 
-def simulate_trajectory(traj_fold, num_iters, f):
-    if traj_fold not in os.listdir():
-        os.system('mkdir ' + traj_fold)
-        os.system('cp ../testing_imgs/' + f + ' ' +traj_fold)
+# resample only the part of source (PIL image) inside box (x0, y0, x1, y1, source
+# pixels, may be fractional) to size (w, h). the source is cropped to the box plus
+# a border wide enough for the kernel, so the cost scales with the output size
+def zoom_roi(source, box, size, resample=Image.BICUBIC, border=4):
+    x0, y0, x1, y1 = box
+    scale = min(size[0]/(x1-x0), size[1]/(y1-y0))
+    pad = int(math.ceil(border*max(1, 1/scale)))
+    cx0, cy0 = max(0, int(x0) - pad), max(0, int(y0) - pad)
+    cx1 = min(source.width, int(math.ceil(x1)) + pad)
+    cy1 = min(source.height, int(math.ceil(y1)) + pad)
+    crop = source.crop((cx0, cy0, cx1, cy1))
+    return np.asarray(crop.resize(tuple(size), resample=resample, box=(x0-cx0, y0-cy0, x1-cx0, y1-cy0)))
 
-    os.system('rm -r testing/joint/*.png')
-    os.system('rm -r testing/grid/*.png')
-    
+# current descent view as a window into the original full-resolution frame:
+# view pixel (u, v) is source pixel offset + (u, v)/scale. each zoom step updates
+# scale and offset and resamples the source once, instead of upsampling an
+# already resampled frame
+class ZoomView:
+    def __init__(self, source, resample=Image.BICUBIC):
+        self.source = source
+        self.resample = resample
+        self.scale = 1.0
+        self.offset = np.zeros(2)
+        self.size = np.array(source.size)
+
+    # zoom by up_amt and keep the window locs = [t, b, l, r] of the zoomed view
+    # (as returned by cropping), i.e. what upsample-then-crop used to produce
+    def move(self, locs, up_amt=2):
+        t, b, l, r = locs
+        self.scale *= up_amt
+        self.offset = self.offset + np.array([l, t])/self.scale
+        self.size = np.array([r-l, b-t])
+
+    def step(self, locs, up_amt=2):
+        self.move(locs, up_amt)
+        return self.render()
+
+    # centre of the view in source pixels
+    def center(self):
+        x0, y0, x1, y1 = self.box()
+        return ((x0 + x1)/2, (y0 + y1)/2)
+
+    def box(self):
+        x0, y0 = self.offset
+        return (x0, y0, x0 + self.size[0]/self.scale, y0 + self.size[1]/self.scale)
+
+    def render(self):
+        return zoom_roi(self.source, self.box(), self.size, self.resample)
+
+# rchar, wchar and the bytes this read itself adds to rchar
+def proc_io():
+    try:
+        with open('/proc/self/io') as fh:
+            text = fh.read()
+        io = dict(line.split(': ') for line in text.splitlines())
+        return int(io['rchar']), int(io['wchar']), len(text)
+    except (OSError, KeyError, ValueError):
+        return 0, 0, 0
+
+def cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+TRACE_FIELDS = [('tid', 'i4'), ('step', 'i4'), ('stage', 'U24'), ('start', 'f8'), ('wall', 'f8'), ('cpu', 'f8'),
+                ('peak_rss', 'i8'), ('read_bytes', 'i8'), ('write_bytes', 'i8')]
+
+# per-stage instrumentation for the descent loop. a StageTracer records wall time,
+# CPU time (this process and its children, e.g. detection subprocesses), peak RSS
+# and bytes read/written (syscall level, less the tracer's own read of
+# /proc/self/io) for each stage of each step. stage peak RSS comes from resetting
+# the linux high-water mark (/proc/self/clear_refs); where that is unavailable it
+# is the process peak so far. NULL_TRACE is the disabled tracer: stage() hands back
+# one shared no-op context, so tracing costs a method call per stage when off
+class StageTracer:
+    def __init__(self, tid=0):
+        self.tid = tid
+        self.events = []
+        self.t0 = time.perf_counter()
+        self.epoch = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, step=-1):
+        reset_peak_rss()
+        r0, w0, own = proc_io()
+        c0 = cpu_time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            c1 = cpu_time()
+            r1, w1, _ = proc_io()
+            self.events.append((self.tid, step, name, t0 - self.t0, t1 - t0, c1 - c0, peak_rss(), r1 - r0 - own,
+                                w1 - w0))
+
+    # events of another tracer (e.g. from a campaign worker) as thread tid, rebased
+    # from that tracer's start (epoch, wall clock) onto this one's
+    def merge(self, events, tid, epoch):
+        shift = epoch - self.epoch
+        self.events.extend((tid, e[1], e[2], e[3] + shift) + tuple(e[4:]) for e in events)
+
+    def table(self):
+        return np.array(self.events, dtype=TRACE_FIELDS)
+
+    # one row per stage: count, total/mean wall, total cpu, max peak rss, bytes
+    def summary(self):
+        t = self.table()
+        rows = []
+        for name in dict.fromkeys(t['stage'].tolist()):
+            sel = t[t['stage'] == name]
+            rows.append((name, len(sel), sel['wall'].sum(), sel['wall'].mean(), sel['cpu'].sum(),
+                         sel['peak_rss'].max(), sel['read_bytes'].sum(), sel['write_bytes'].sum()))
+        return rows
+
+    def print_summary(self):
+        print('%-16s %6s %10s %10s %10s %10s %12s %12s' % ('stage', 'count', 'wall_s', 'mean_ms', 'cpu_s',
+                                                          'rss_mb', 'read', 'written'))
+        for name, n, wall, mean, cpu, rss, rb, wb in self.summary():
+            print('%-16s %6d %10.3f %10.2f %10.3f %10.1f %12d %12d' % (name, n, wall, mean*1e3, cpu, rss/2**20,
+                                                                       rb, wb))
+
+    # chrome://tracing / perfetto "complete" events, times in microseconds
+    def save_chrome_trace(self, fname):
+        events = [{'name': name, 'cat': 'descent', 'ph': 'X', 'ts': start*1e6, 'dur': wall*1e6, 'pid': 0,
+                   'tid': tid, 'args': {'step': step, 'cpu_s': cpu, 'peak_rss': rss, 'read_bytes': rb,
+                                        'write_bytes': wb}}
+                  for tid, step, name, start, wall, cpu, rss, rb, wb in self.events]
+        with open(fname, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+class NullTracer:
+    def __init__(self):
+        self.null = contextlib.nullcontext()
+
+    def stage(self, name, step=-1):
+        return self.null
+
+NULL_TRACE = NullTracer()
+
+# keras save_img scaling (divide by the max, times 255), so frames kept in memory
+# are the ones the old loop wrote out and read back
+def stretch(x):
+    x = np.asarray(x, dtype=np.float32)
+    x = x + max(-x.min(), 0)
+    if x.max() != 0:
+        x = x/x.max()
+    return (x*255).astype(np.uint8)
+
+# files render_step writes for step i: grid, weight overlay and chosen tile
+def step_paths(workspace, i, name, min_f):
+    return (os.path.join(workspace, 'grid', 'grid_' + name.split('/')[-1]),
+            os.path.join(workspace, 'joint', str(i) + '_joined.png'),
+            os.path.join(workspace, 'splitimg', min_f))
+
+def preview(*paths):
+    for f in paths:
+        os.system('imgcat ' + f)
+
+# presentation for one step, written into workspace: boxes on the frame, the grid
+# with the chosen move, the weight overlay and the chosen tile (imgcat'd when
+# show is set)
+def render_step(workspace, i, name, frame, boxes, mult, min_c, dist_dict, min_f, show, trace=NULL_TRACE):
+    paths = step_paths(workspace, i, name, min_f)
+    with trace.stage('draw_boxes', i):
+        boxed = draw_boxes(frame, boxes)
+    with trace.stage('draw_grid', i):
+        draw_grid(name, mult, min_c, boxed, os.path.join(workspace, 'grid'), False)
+    with trace.stage('mask_weights', i):
+        mask_weights(str(i), dist_dict, boxed, mult**2, os.path.join(workspace, 'joint'))
+    with trace.stage('tiles', i):
+        tiles = TileGrid(frame, mult**2)
+        Image.fromarray(tiles.tile(tiles.names.index(min_f))).save(paths[2])
+    if show:
+        with trace.stage('imgcat', i):
+            preview(*paths)
+
+def save_frame(workspace, i, name, gray, show, trace=NULL_TRACE):
+    with trace.stage('save', i):
+        Image.fromarray(gray).save(os.path.join(workspace, name))
+    if show:
+        with trace.stage('imgcat', i):
+            preview(os.path.join(workspace, name))
+
+# background thread for descent visuals with a bounded queue, so presentation
+# never blocks the decision loop. jobs are keyed by what they produce: file
+# writes get a key of their own (e.g. ('frame', step)), previews share 'preview'.
+# below maxsize every job is queued. once full, a job whose key is already queued
+# replaces that one (moved to the back, so only the newest preview is shown) when
+# coalesce is set, and any other job is dropped (submit returns False, so the
+# caller can skip the preview of a file that will not exist). close() (or leaving
+# the with block) drains the queue and, when jobs were dropped or failed, writes
+# the counts and errors to log
+class VisualWriter:
+    def __init__(self, maxsize=4, coalesce=True, log=sys.stderr):
+        self.maxsize = maxsize
+        self.coalesce = coalesce
+        self.log = log
+        self.jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.written = self.dropped = self.coalesced = 0
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, fn, *args):
+        with self.cond:
+            if len(self.jobs) >= self.maxsize:
+                old = next((job for job in self.jobs if job[0] == key), None) if self.coalesce else None
+                if old is None:
+                    self.dropped += 1
+                    return False
+                self.jobs.remove(old)
+                self.coalesced += 1
+            self.jobs.append((key, fn, args))
+            self.cond.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                key, fn, args = self.jobs.popleft()
+            try:
+                fn(*args)
+                self.written += 1
+            except Exception as e:
+                self.errors.append((key, e))
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        if self.log is not None and (self.dropped or self.errors):
+            self.log.write('visuals: %d written, %d dropped, %d coalesced, %d failed\n'
+                           % (self.written, self.dropped, self.coalesced, len(self.errors)))
+            for key, e in self.errors:
+                self.log.write('  %s: %r\n' % (key, e))
+
+    def stats(self):
+        return {'written': self.written, 'dropped': self.dropped, 'coalesced': self.coalesced,
+                'errors': list(self.errors)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# one descent from f (path or array; non-uint8 arrays such as crater_terrain
+# output are scaled to 0..255 with stretch): detect, score the grid and zoom into
+# the best tile, num_iters times. frames stay in memory; the zoomed frames and, with
+# render, the grid/overlay/tile images are only written when workspace (a
+# directory owned by this run) is given, and previewed with imgcat when show is
+# set. with a writer (VisualWriter) that presentation runs on its thread instead of
+# inline; headless skips it all. detector is a name from DETECTORS or an object
+# with detect(); zoom_backend 'pil' resamples the original frame through ZoomView,
+# any other SR_BACKENDS name upsamples the current frame with that (cached) model.
+# returns the per-step picks (step, num_tiles, tile, dx, dy, score), the landing
+# point in source pixels and the final zoom. trace (a StageTracer) times every stage
+def descend(f, num_iters, dist_weight=0.038, detector='yolo', zoom_backend='pil', workspace=None, render=False,
+            show=False, trace=NULL_TRACE, writer=None, headless=False):
+    if headless:
+        workspace, render, show = None, False, False
+    with trace.stage('setup'):
+        detector = get_detector(detector)
+        if isinstance(f, str):
+            name = os.path.basename(f)
+            source = Image.open(f).convert('L')
+            frame = load_rgb(f)
+        else:
+            name = 'frame.png'
+            f = np.asarray(f)
+            frame = as_rgb(f if f.dtype == np.uint8 else stretch(f))
+            source = Image.fromarray(frame).convert('L')
+        gray = np.asarray(source)
+    zoom = ZoomView(source)
+    if workspace is not None:
+        for d in ('grid', 'joint', 'splitimg') if render else ('',):
+            os.makedirs(os.path.join(workspace, d), exist_ok=True)
+
+    steps = []
     for i in range(num_iters): #loop through algo n times
         mult = num_iters - i + (1 if (num_iters-i)%2  == 0 else 2)
         num_tiles = mult**2
-        os.system('rm testing/split/*.png')
-        os.system('rm testing/splitimg/*.png')
-        os.system('rm -r runs/detect/exp')
-        os.system('rm -r runs/detect/exp2')
-        os.system('rm -r testing/splitmask/*.png')
-        
-        #split original image
-        tiles = image_slicer.slice(traj_fold +f, num_tiles, save=False)
-        image_slicer.save_tiles(tiles, directory='testing/splitimg/', prefix='img')
-        
-        #detect on the image and preview it
-        os.system('python ../low_alt_nn/obj_det/yolov5/edit_detect.py --weights ../low_alt_nn/obj_det/yolov5/runs/train/iter3/weights/best.pt --source ' + traj_fold + f + ' --img-size 350  --hide-labels --conf 0.5')
-        os.system('python ../low_alt_nn/obj_det/yolov5/detect.py --weights ../low_alt_nn/obj_det/yolov5/runs/train/iter3/weights/best.pt --source ' + traj_fold + f + ' --img-size 350  --hide-labels --conf 0.5')
+
+        #detect on the image
+        with trace.stage('detect', i):
+            boxes = detector.detect(frame)
+        with trace.stage('hazards', i):
+            hazards = HazardIndex.from_boxes(frame.shape, boxes)
 
         #identify and display best spot in current image
-        min_c, min_f, dist_dict = next_trajectory('runs/detect/exp/'+f, num_tiles, 'testing/split/', 0.038)
-        img_size = draw_grid('runs/detect/exp2/' +f, mult, min_c)
-        print(min_f)
-        mask_weights(str(i),dist_dict, 'runs/detect/exp2/' +f, 'testing/splitmask/',num_tiles)
-        os.system('imgcat testing/joint/' + str(i) + '_joined.png')
-        os.system('imgcat testing/splitimg/' + min_f)
-
-        #upsample new spot  
-        new_f = PIL_bicubic(traj_fold+f, 2)
-        #new_f = edsr_nn_upsample(traj_fold+f, 2)
-        #new_f = isr_nn_upsample_old(traj_fold+f)
+        with trace.stage('next_trajectory', i):
+            min_c, min_f, dist_dict = next_trajectory(hazards, num_tiles, dist_weight)
+        steps.append((i, num_tiles, min_f, int(min_c[0]), int(min_c[1]), float(dist_dict[min_f])))
+        img_size = (frame.shape[1], frame.shape[0])
+        if show:
+            print(min_f)
+        if render and workspace is not None:
+            if writer is None:
+                render_step(workspace, i, name, frame, boxes, mult, min_c, dist_dict, min_f, show, trace)
+            else:
+                with trace.stage('submit', i):
+                    queued = writer.submit(('step', i), render_step, workspace, i, name, frame, boxes, mult,
+                                           min_c, dist_dict, min_f, False)
+                    if show and queued:
+                        writer.submit('preview', preview, *step_paths(workspace, i, name, min_f))
+
+        #upsample new spot (only the kept window)
         min_c = min_c*2
-        img_c = np.array([len(new_f[0])//2, len(new_f)//2])
-        move = img_c + min_c*np.array([1,-1])
         w = img_size[0]
         h = img_size[1]
-        locs = cropping(w,h,move) 
-        new_f = new_f[locs[0]:locs[1],locs[2]:locs[3]] 
-        save_dir = traj_fold + 'new_' + min_f
-        #new_f = Image.fromarray(new_f).convert('L')
-        new_f  = np.expand_dims(new_f, axis = -1)
-        save_img(save_dir, new_f)
-        f = save_dir.split('/')[1]
-        os.system('imgcat '+ traj_fold +f)
-        del new_f
+        img_c = np.array([w, h]) #center of the 2x frame
+        move = img_c + min_c*np.array([1,-1])
+        locs = cropping(w,h,move)
+        with trace.stage('zoom', i):
+            if zoom_backend == 'pil':
+                new_f = zoom.step(locs, 2)
+            else:
+                zoom.move(locs, 2)
+                new_f = sr_zoom(get_sr_model(zoom_backend), gray, locs, 2)
+            gray = stretch(new_f)
+            frame = as_rgb(gray)
+        name = 'new_' + min_f
+        if workspace is not None:
+            if writer is None:
+                save_frame(workspace, i, name, gray, show, trace)
+            else:
+                with trace.stage('submit', i):
+                    queued = writer.submit(('frame', i), save_frame, workspace, i, name, gray, False)
+                    if show and queued:
+                        writer.submit('preview', preview, os.path.join(workspace, name))
+    return {'steps': steps, 'landing': zoom.center(), 'scale': zoom.scale}
+
+# single descent on ../testing_imgs/f with traj_fold as its workspace. visuals
+# are drawn on a VisualWriter thread when async_visuals is set; its counts and
+# errors are reported when it closes and returned under 'visuals'
+def simulate_trajectory(traj_fold, num_iters, f, detector='yolo', render=True, zoom_backend='pil',
+                        trace=NULL_TRACE, headless=False, async_visuals=False):
+    if not os.path.exists(os.path.join(traj_fold, f)):
+        os.makedirs(traj_fold, exist_ok=True)
+        shutil.copy('../testing_imgs/' + f, traj_fold)
+    writer = VisualWriter() if async_visuals and not headless else None
+    with writer if writer is not None else contextlib.nullcontext():
+        result = descend(os.path.join(traj_fold, f), num_iters, 0.038, detector, zoom_backend, traj_fold, render,
+                         show=True, trace=trace, writer=writer, headless=headless)
+    if writer is not None:
+        result['visuals'] = writer.stats()
+    return result
+
+CAMPAIGN_FIELDS = [('run', 'i4'), ('image', 'U256'), ('num_iters', 'i4'), ('dist_weight', 'f8'),
+                   ('zoom_backend', 'U16'), ('land_x', 'f8'), ('land_y', 'f8'), ('scale', 'f8'), ('wall_time', 'f8')]
+STEP_FIELDS = [('run', 'i4'), ('step', 'i4'), ('num_tiles', 'i4'), ('tile', 'U32'), ('dx', 'i4'), ('dy', 'i4'),
+               ('score', 'f8')]
+
+# one campaign descent in its own workspace: workspace_root/run_NNNNN when given
+# (kept), a temporary directory when only render is set (removed afterwards),
+# none at all otherwise
+def campaign_run(job):
+    run, image, num_iters, dist_weight, zoom_backend, detector, render, workspace_root, traced = job
+    trace = StageTracer(run) if traced else NULL_TRACE
+    t0 = time.perf_counter()
+    tmp = None
+    if workspace_root is not None:
+        workspace = os.path.join(workspace_root, 'run_%05d' % run)
+        os.makedirs(workspace, exist_ok=True)
+    elif render:
+        tmp = tempfile.TemporaryDirectory(prefix='descent_%05d_' % run)
+        workspace = tmp.name
+    else:
+        workspace = None
+    try:
+        res = descend(image, num_iters, dist_weight, detector, zoom_backend, workspace, render, trace=trace)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    wall = time.perf_counter() - t0
+    name = image if isinstance(image, str) else '<array %d>' % run
+    row = (run, name, num_iters, dist_weight, zoom_backend) + tuple(res['landing']) + (res['scale'], wall)
+    return row, [(run,) + step for step in res['steps']], (trace.epoch, trace.events) if traced else None
+
+# every image under every combination of num_iters, dist_weight and zoom_backend,
+# run concurrently on a process pool (models are loaded once per worker). returns
+# the per-run table (landing point in source pixels) and the per-step table. with
+# trace (a StageTracer) each run's stage events are collected into it, one trace
+# thread per run
+def run_campaign(images, num_iters=(3,), dist_weight=(0.038,), zoom_backend=('pil',), detector='yolo',
+                 workers=None, render=False, workspace_root=None, trace=None):
+    grid = itertools.product(images, num_iters, dist_weight, zoom_backend)
+    jobs = [(run, image, n, d, z, detector, render, workspace_root, trace is not None)
+            for run, (image, n, d, z) in enumerate(grid)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(campaign_run, jobs, chunksize=max(1, len(jobs)//(4*(workers or os.cpu_count() or 1)))))
+    runs = np.array([r[0] for r in results], dtype=CAMPAIGN_FIELDS)
+    steps = np.array([s for r in results for s in r[1]], dtype=STEP_FIELDS)
+    if trace is not None:
+        for r in results:
+            trace.merge(r[2][1], r[0][0], r[2][0])
+    return runs, steps
+
+def save_campaign(fname, runs, steps):
+    np.savez(fname, runs=runs, steps=steps)
+
+# super-resolution backends: each loads its model once and upsample(image, scale)
+# maps an array to an array. grayscale frames are run as 3 equal channels and
+# averaged back. neural models run through tiled_predict so memory stays bounded
+
+# split image into tile x tile blocks with a halo of context on every side, run
+# fn on batches of them and blend the overlapping outputs with linear ramps across
+# the halos. fn maps (B, h, w, C) to (B, h*scale, w*scale, C)
+def tiled_predict(fn, image, scale, tile=128, halo=16, batch_size=8):
+    H, W = image.shape[:2]
+    ny, nx = -(-H // tile), -(-W // tile)
+    pad = ((halo, ny*tile - H + halo), (halo, nx*tile - W + halo)) + ((0, 0),)*(image.ndim - 2)
+    src = np.pad(image, pad, mode='reflect')
+    size = (tile + 2*halo)*scale
+    ramp = np.ones(size, dtype=np.float32)
+    edge = np.linspace(0, 1, 2*halo*scale + 2, dtype=np.float32)[1:-1]
+    ramp[:len(edge)] = edge
+    ramp[size-len(edge):] = edge[::-1]
+    wtile = np.outer(ramp, ramp)[..., None]
+
+    out = np.zeros(((ny*tile + 2*halo)*scale, (nx*tile + 2*halo)*scale, src.shape[2] if src.ndim == 3 else 1), dtype=np.float32)
+    wsum = np.zeros(out.shape[:2] + (1,), dtype=np.float32)
+    origins = [(y, x) for y in range(0, ny*tile, tile) for x in range(0, nx*tile, tile)]
+    for k in range(0, len(origins), batch_size):
+        batch = origins[k:k+batch_size]
+        pred = fn(np.stack([src[y:y+tile+2*halo, x:x+tile+2*halo] for y, x in batch]))
+        pred = pred.reshape(len(batch), size, size, -1)
+        for (y, x), p in zip(batch, pred):
+            out[y*scale:y*scale+size, x*scale:x*scale+size] += p*wtile
+            wsum[y*scale:y*scale+size, x*scale:x*scale+size] += wtile
+    out /= np.maximum(wsum, 1e-6)
+    out = out[halo*scale:(halo+H)*scale, halo*scale:(halo+W)*scale]
+    return out[..., 0] if image.ndim == 2 else out
+
+def as_rgb(image):
+    return np.repeat(image[..., None], 3, axis=-1) if image.ndim == 2 else image
+
+def from_rgb(out, like):
+    out = np.clip(out, 0, 255).astype(np.uint8)
+    return out.mean(-1).astype(np.uint8) if like.ndim == 2 else out
+
+# resize to the exact requested scale when a model has a fixed factor
+def to_scale(out, shape, scale):
+    if out.shape[0] == shape[0]*scale and out.shape[1] == shape[1]*scale:
+        return out
+    return np.asarray(Image.fromarray(out).resize((shape[1]*scale, shape[0]*scale), resample=Image.BICUBIC))
+
+class PILUpsampler:
+    def __init__(self, resample=Image.BICUBIC):
+        self.resample = resample
+
+    def upsample(self, image, scale):
+        im = Image.fromarray(image)
+        return np.asarray(im.resize((im.size[0]*scale, im.size[1]*scale), resample=self.resample))
+
+class ISRUpsampler:
+    def __init__(self, weights='gans', tile=96, halo=8, batch_size=8):
+        from ISR.models import RDN, RRDN
+        #model = RDN(weights='noise-cancel')
+        #model = RDN(weights='psnr-small')
+        #model = RDN(weights='psnr-large')
+        self.model = RRDN(weights=weights) if weights == 'gans' else RDN(weights=weights)
+        self.scale = self.model.scale
+        self.tile, self.halo, self.batch_size = tile, halo, batch_size
+
+    def predict(self, batch):
+        return self.model.model.predict(batch.astype(np.float32)/255.)*255.
+
+    def upsample(self, image, scale):
+        out = tiled_predict(self.predict, as_rgb(image), self.scale, self.tile, self.halo, self.batch_size)
+        return to_scale(from_rgb(out, image), image.shape, scale)
+
+EDSR_DIR = 'up_nn/EDSR-PyTorch'
+EDSR_URLS = {
+    2: 'https://cv.snu.ac.kr/research/EDSR/models/edsr_baseline_x2-1bfb3e2e.pt',
+    3: 'https://cv.snu.ac.kr/research/EDSR/models/edsr_baseline_x3-abf2a44e.pt',
+    4: 'https://cv.snu.ac.kr/research/EDSR/models/edsr_baseline_x4-6b446fab.pt',
+}
+
+# EDSR baseline from the local EDSR-PyTorch checkout, run in-process
+class EDSRUpsampler:
+    def __init__(self, scale=2, weights=None, tile=96, halo=8, batch_size=4):
+        import torch
+        sys.path.insert(0, EDSR_DIR + '/src')
+        from model import edsr
+        args = argparse.Namespace(n_resblocks=16, n_feats=64, scale=[scale], rgb_range=255, n_colors=3,
+                                  res_scale=1)
+        self.torch = torch
+        self.model = edsr.make_model(args)
+        state = torch.load(weights) if weights else torch.hub.load_state_dict_from_url(EDSR_URLS[scale])
+        self.model.load_state_dict(state, strict=False)
+        self.model.eval()
+        self.scale = scale
+        self.tile, self.halo, self.batch_size = tile, halo, batch_size
+
+    def predict(self, batch):
+        with self.torch.no_grad():
+            x = self.torch.from_numpy(batch.astype(np.float32)).permute(0, 3, 1, 2)
+            return self.model(x).permute(0, 2, 3, 1).numpy()
+
+    def upsample(self, image, scale):
+        out = tiled_predict(self.predict, as_rgb(image), self.scale, self.tile, self.halo, self.batch_size)
+        return to_scale(from_rgb(out, image), image.shape, scale)
+
+# interpolation from upsampling_lunar_lander: method is 'bilinear', 'bicubic',
+# 'diamond_square' or 'full_procedure' (noise seeded by seed). those work on
+# corner-aligned points, so the frame is edge-padded by one pixel and the result
+# cut to scale times the frame size; colour frames run per channel
+class ClassicalUpsampler:
+    def __init__(self, method='bicubic', cutoff_freq=0.7, beta=0.7, order=2, ds_temp=25, seed=0):
+        import upsampling_lunar_lander as ul
+        self.ul = ul
+        self.method = method
+        self.params = (cutoff_freq, beta, order, ds_temp)
+        self.seed = seed
+
+    def upsample_gray(self, image, scale):
+        ul = self.ul
+        cutoff_freq, beta, order, ds_temp = self.params
+        im = np.pad(np.asarray(image, dtype=np.float64), ((0, 1), (0, 1)), mode='edge')
+        if self.method == 'bilinear':
+            out = ul.upsample(im, scale, ul.bilinear)
+        elif self.method == 'bicubic':
+            out = ul.upsample(im, scale, ul.bicubic, 1/scale, -1/2)
+        elif self.method == 'diamond_square':
+            out = ul.just_diamond_square(im, scale, ul.cr_spline, ds_temp, rng=np.random.default_rng(self.seed))
+        elif self.method == 'full_procedure':
+            out = ul.full_procedure(im, scale, cutoff_freq, beta, order, ul.avg_test, ds_temp,
+                                    rng=np.random.default_rng(self.seed))
+        else:
+            raise ValueError('unknown classical method ' + repr(self.method))
+        return out[:image.shape[0]*scale, :image.shape[1]*scale]
+
+    def upsample(self, image, scale):
+        if image.ndim == 2:
+            out = self.upsample_gray(image, scale)
+        else:
+            out = np.stack([self.upsample_gray(image[..., c], scale) for c in range(image.shape[2])], axis=-1)
+        return np.clip(out, 0, 255).astype(np.uint8)
+
+# backend name -> factory; factories do their own heavy imports, so only the
+# backends a run actually uses are ever loaded
+SR_BACKENDS = {
+    'pil': PILUpsampler,
+    'classical': ClassicalUpsampler,
+    'isr': ISRUpsampler,
+    'edsr': EDSRUpsampler,
+}
+SR_MODELS = {}
+
+def register_sr_backend(name, factory):
+    SR_BACKENDS[name] = factory
+
+# warm model for a backend, built on first use and reused afterwards
+def get_sr_model(name, **kwargs):
+    key = (name, tuple(sorted(kwargs.items())))
+    if key not in SR_MODELS:
+        SR_MODELS[key] = SR_BACKENDS[name](**kwargs)
+    return SR_MODELS[key]
+
+# zoom step for a fixed-factor backend: upsample only the source window under
+# locs = [t, b, l, r] of the up_amt frame (plus a halo) and cut the window out
+def sr_zoom(model, frame, locs, up_amt=2, halo=8):
+    t, b, l, r = locs
+    y0, x0 = max(0, t//up_amt - halo), max(0, l//up_amt - halo)
+    y1 = min(frame.shape[0], -(-b//up_amt) + halo)
+    x1 = min(frame.shape[1], -(-r//up_amt) + halo)
+    up = model.upsample(np.ascontiguousarray(frame[y0:y1, x0:x1]), up_amt)
+    return up[t - y0*up_amt:b - y0*up_amt, l - x0*up_amt:r - x0*up_amt]
 
 def edsr_nn_upsample(f, num_up):
-    os.system('rm up_nn/EDSR-PyTorch/test/*png*')
-    os.system('cp ' + f + ' up_nn/EDSR-PyTorch/test')
-    os.system('python3 up_nn/EDSR-PyTorch/src/main.py --data_test Demo --scale ' + str(num_up) + '  --test_only --save_results --dir_demo up_nn/EDSR-PyTorch/test')
-    newf = 'up_nn/EDSR-PyTorch/experiment/test/results-Demo/' + f.split('/')[-1]
-    return np.asarray(Image.open(newf)) 
+    return get_sr_model('edsr', scale=num_up).upsample(load_rgb(f), num_up)
 
 def isr_nn_upsample_old(f):
-    img = Image.open(f).convert('RGB')
-    lr_img = np.array(img)
-    
-    #model = RDN(weights='noise-cancel')
-    model = RRDN(weights='gans')
-    #model = RDN(weights='psnr-small')
-    #model = RDN(weights='psnr-large')
-    return model.predict(lr_img) #, by_patch_of_size=10)
+    model = get_sr_model('isr')
+    return model.upsample(load_rgb(f), model.scale)
 
 if __name__ == "__main__":
-    #simulate_trajectory('yolotest2/', 4, 'yolotest2.png')
-    #simulate_trajectory('test8/', 3, 'test8.png')
-    simulate_trajectory('apollo_traj/', 2, 'apollo113km.png')
+    parser = argparse.ArgumentParser(description='lunar descent; runs the apollo demo unless --campaign is given')
+    parser.add_argument('--campaign', nargs='+', default=None, help='start images for a landing campaign')
+    parser.add_argument('--iters', type=int, nargs='+', default=[3])
+    parser.add_argument('--dist-weight', type=float, nargs='+', default=[0.038])
+    parser.add_argument('--zoom-backend', nargs='+', default=['pil'], choices=list(SR_BACKENDS))
+    parser.add_argument('--detector', default='yolo', choices=list(DETECTORS))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--render', action='store_true', help='write grid/overlay/tile images per run')
+    parser.add_argument('--workspace', default=None, help='keep per-run workspaces under this directory')
+    parser.add_argument('--out', default=None, help='.npz file for the results tables')
+    parser.add_argument('--headless', action='store_true', help='no images, previews or saved frames')
+    parser.add_argument('--async-visuals', action='store_true', help='draw visuals on a background thread')
+    parser.add_argument('--trace', default=None, help='write a chrome trace (.json) and print a stage summary')
+    args = parser.parse_args()
+
+    trace = StageTracer() if args.trace else None
+    if args.campaign is None:
+        #simulate_trajectory('yolotest2/', 4, 'yolotest2.png')
+        #simulate_trajectory('test8/', 3, 'test8.png')
+        simulate_trajectory('apollo_traj/', 2, 'apollo113km.png', detector=args.detector, trace=trace or NULL_TRACE,
+                            headless=args.headless, async_visuals=args.async_visuals)
+    else:
+        runs, steps = run_campaign(args.campaign, args.iters, args.dist_weight, args.zoom_backend, args.detector,
+                                   args.workers, args.render, args.workspace, trace)
+        print(' '.join(name for name, _ in CAMPAIGN_FIELDS))
+        for row in runs.tolist():
+            print(' '.join('%g' % v if not isinstance(v, str) else v for v in row))
+        if args.out is not None:
+            save_campaign(args.out, runs, steps)
+    if trace is not None:
+        trace.print_summary()
+        trace.save_chrome_trace(args.trace)
@@ -0,0 +1,39 @@
+#----------------------------------------------------------#
+# Process memory readings from /proc, shared by the descent
+# tracer (lunar_landing_sim) and upsampling_benchmark
+#----------------------------------------------------------#
+
+import sys
+import resource
+
+# True when the high-water mark could be reset to the current RSS
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+# current resident set size in bytes, None where /proc is unavailable
+def current_rss():
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+# peak resident set size in bytes
+def peak_rss():
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
@@ -0,0 +1,112 @@
+#--------------------------------------------------------------------#
+# Checks the whole-image upsample against the original per-window loop
+#--------------------------------------------------------------------#
+
+import sys
+import types
+import numpy as np
+
+# upsampling_utils is not part of this repository. when it cannot be imported a
+# stub stands in for it: bilinear fills a window by corner-aligned bilinear
+# interpolation of its 4 corners (what the whole-image fast path assumes, see
+# is_bilinear), diamond_square_algorithm is that plus np.random noise inside the
+# window, and cr_spline/avg_test are only there for the import
+def stub_bilinear(pre_im):
+    n = pre_im.shape[0]
+    t = np.linspace(0, 1, n)
+    top = pre_im[0, 0]*(1 - t) + pre_im[0, -1]*t
+    bottom = pre_im[-1, 0]*(1 - t) + pre_im[-1, -1]*t
+    return top[None, :]*(1 - t[:, None]) + bottom[None, :]*t[:, None]
+
+def stub_diamond_square(pre_im, ds_func, ds_temp):
+    out = stub_bilinear(pre_im)
+    out[1:-1, 1:-1] += np.random.normal(0, 1, out[1:-1, 1:-1].shape)
+    return out
+
+try:
+    import upsampling_utils
+except ImportError:
+    upsampling_utils = types.ModuleType('upsampling_utils')
+    upsampling_utils.bilinear = stub_bilinear
+    upsampling_utils.diamond_square_algorithm = stub_diamond_square
+    upsampling_utils.cr_spline = None
+    upsampling_utils.avg_test = None
+    sys.modules['upsampling_utils'] = upsampling_utils
+
+from upsampling_lunar_lander import upsample, bicubic, is_bilinear
+
+# the original upsample loop (prints dropped): every window's output is added in
+# and the edges shared with earlier windows are halved
+def old_upsample(im, up_amt, up_func, *extra_ps):
+    up_im = np.zeros((up_amt*im.shape[0] - (up_amt - 1), up_amt*im.shape[1] - (up_amt - 1)))
+    sub_size = 1 + up_amt
+    for i in range(im.shape[0] - 1):
+        for j in range(im.shape[1] - 1):
+            pre_im = np.zeros((sub_size, sub_size))
+            pre_im[0, 0] = im[i,j]
+            pre_im[0,-1] = im[i,j+1]
+            pre_im[-1, 0] = im[i+1, j]
+            pre_im[-1,-1] = im[i+1,j+1]
+            sub_out = up_func(pre_im, *extra_ps)
+            up_im[i*up_amt:i*up_amt+sub_size, j*up_amt:j*up_amt+sub_size] += sub_out
+            if j != 0 and i < im.shape[0] - 2:
+                up_im[i*up_amt:i*up_amt+sub_size-1, j*up_amt] /= 2
+            elif j != 0 and i == im.shape[0] - 2:
+                up_im[i*up_amt:i*up_amt+sub_size, j*up_amt] /= 2
+        if i != 0:
+            up_im[i*up_amt,:] /= 2
+    return up_im
+
+# Keys kernel, scalar
+def keys(x, a):
+    x = abs(x)
+    if x <= 1:
+        return (a + 2)*x**3 - (a + 3)*x**2 + 1
+    if x < 2:
+        return a*x**3 - 5*a*x**2 + 8*a*x - 4*a
+    return 0.
+
+# per-pixel cubic convolution on the corner-aligned grid, edges clamped
+def naive_bicubic(im, up_amt, ratio, coeff):
+    n, m = im.shape
+    out = np.zeros(((n - 1)*up_amt + 1, (m - 1)*up_amt + 1))
+    for r in range(out.shape[0]):
+        ci = min(r // up_amt, n - 2)
+        ty = (r - ci*up_amt)*ratio
+        for c in range(out.shape[1]):
+            cj = min(c // up_amt, m - 2)
+            tx = (c - cj*up_amt)*ratio
+            for di in range(-1, 3):
+                for dj in range(-1, 3):
+                    y = min(max(ci + di, 0), n - 1)
+                    x = min(max(cj + dj, 0), m - 1)
+                    out[r, c] += keys(ty - di, coeff)*keys(tx - dj, coeff)*im[y, x]
+    return out
+
+def test_bilinear_matches_window_loop():
+    im = np.random.default_rng(0).uniform(0, 255, (9, 13))
+    for up_amt in (2, 3, 4):
+        assert is_bilinear(up_amt)
+        expected = old_upsample(im, up_amt, upsampling_utils.bilinear)
+        np.testing.assert_allclose(upsample(im, up_amt, upsampling_utils.bilinear), expected, atol=1e-9)
+
+# any other window function still goes through the loop, averaged like before
+def test_window_function_matches_window_loop():
+    im = np.random.default_rng(1).uniform(0, 255, (7, 6))
+    shaded = lambda pre_im: stub_bilinear(pre_im)**1.5
+    for up_amt in (2, 4):
+        np.testing.assert_allclose(upsample(im, up_amt, shaded), old_upsample(im, up_amt, shaded), atol=1e-9)
+
+def test_bicubic_matches_per_pixel():
+    im = np.random.default_rng(2).uniform(0, 255, (8, 10))
+    for up_amt in (2, 3, 4):
+        expected = naive_bicubic(im, up_amt, 1/up_amt, -0.5)
+        np.testing.assert_allclose(upsample(im, up_amt, bicubic, 1/up_amt, -0.5), expected, atol=1e-9)
+
+# the same rng gives the same diamond square noise
+def test_diamond_square_seeded():
+    im = np.random.default_rng(3).uniform(0, 255, (6, 6))
+    ds = upsampling_utils.diamond_square_algorithm
+    a = upsample(im, 4, ds, upsampling_utils.cr_spline, 25, rng=np.random.default_rng(7))
+    b = upsample(im, 4, ds, upsampling_utils.cr_spline, 25, rng=np.random.default_rng(7))
+    np.testing.assert_array_equal(a, b)
@@ -0,0 +1,203 @@
+#------------------------------------------------------------------#
+# Upsampling benchmark: downsample reference frames, upsample them
+# back with every zoom backend and score speed, memory and quality
+#------------------------------------------------------------------#
+
+import numpy as np
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import gaussian_filter
+
+from upsampling_lunar_lander import (upsample, bicubic, full_procedure, just_bilinear, just_diamond_square,
+                                     PIL_bilinear, PIL_bicubic, PIL_lanczos, open_gray)
+from upsampling_utils import avg_test, cr_spline
+from proc_stats import reset_peak_rss, peak_rss, current_rss
+
+# fractal (1/f^beta spectrum) height field, zero mean and unit std
+def fractal_heights(size, beta, rng):
+    ky = np.fft.fftfreq(size)[:, None]
+    kx = np.fft.rfftfreq(size)[None, :]
+    k = np.hypot(ky, kx)
+    k[0, 0] = 1
+    spec = k**(-beta/2)*np.exp(2j*np.pi*rng.random(k.shape))
+    spec[0, 0] = 0
+    h = np.fft.irfft2(spec, s=(size, size))
+    return (h - h.mean())/h.std()
+
+# bowl with a raised rim for a crater of radius R at distance r from its centre
+def crater_profile(r, R):
+    x = r/R
+    return np.where(x < 1, x*x - 1 + 0.25, 0.25*np.minimum(1, x)**-6)*np.exp(-np.maximum(x - 1, 0))
+
+# synthetic lunar terrain frame (0..255): fractal relief plus craters with power
+# law radii, hill shaded with the sun at azimuth/elevation (degrees). lets the
+# benchmark run without any image assets
+def crater_terrain(size=512, num_craters=60, seed=0, beta=3.0, rmin=3, rmax=None, sun=(315, 30)):
+    rng = np.random.default_rng(seed)
+    rmax = size/8 if rmax is None else rmax
+    h = fractal_heights(size, beta, rng)*size/200
+    a = 1.8  # cumulative size distribution ~ r^-a
+    radii = rmin*(1 - rng.random(num_craters)*(1 - (rmin/rmax)**a))**(-1/a)
+    for R, cy, cx in zip(radii, rng.random(num_craters)*size, rng.random(num_craters)*size):
+        ext = int(np.ceil(3*R))
+        y0, y1 = max(0, int(cy) - ext), min(size, int(cy) + ext + 1)
+        x0, x1 = max(0, int(cx) - ext), min(size, int(cx) + ext + 1)
+        if y0 >= y1 or x0 >= x1:
+            continue
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        h[y0:y1, x0:x1] += 0.4*R*crater_profile(np.hypot(yy - cy, xx - cx), R)
+
+    az, el = np.radians(sun[0]), np.radians(sun[1])
+    gy, gx = np.gradient(h)
+    shade = (np.sin(el) + np.cos(el)*(gx*np.sin(az) - gy*np.cos(az)))/np.sqrt(1 + gx*gx + gy*gy)
+    shade = np.clip(shade, 0, None)
+    return 255*shade/max(shade.max(), 1e-12)
+
+# low resolution input and the matching ground truth. grid backends (upsample and
+# friends) interpolate between points and return (h-1)*up_amt+1 points, so they get
+# point samples; pixel backends (PIL, neural) return h*up_amt pixels, so they get
+# box averages
+def degrade(truth, up_amt, grid):
+    if grid:
+        low = truth[::up_amt, ::up_amt]
+        n, m = (low.shape[0] - 1)*up_amt + 1, (low.shape[1] - 1)*up_amt + 1
+        return low, truth[:n, :m]
+    h, w = truth.shape[0]//up_amt, truth.shape[1]//up_amt
+    ref = truth[:h*up_amt, :w*up_amt]
+    return ref.reshape(h, up_amt, w, up_amt).mean(axis=(1, 3)), ref
+
+def psnr(ref, out, peak=255.):
+    mse = np.mean((np.asarray(ref, dtype=np.float64) - np.asarray(out, dtype=np.float64))**2)
+    return np.inf if mse == 0 else 10*np.log10(peak*peak/mse)
+
+# mean structural similarity with the usual gaussian window (sigma 1.5)
+def ssim(ref, out, peak=255., sigma=1.5):
+    x, y = np.asarray(ref, dtype=np.float64), np.asarray(out, dtype=np.float64)
+    c1, c2 = (0.01*peak)**2, (0.03*peak)**2
+    mx, my = gaussian_filter(x, sigma), gaussian_filter(y, sigma)
+    vx = gaussian_filter(x*x, sigma) - mx*mx
+    vy = gaussian_filter(y*y, sigma) - my*my
+    cxy = gaussian_filter(x*y, sigma) - mx*my
+    s = ((2*mx*my + c1)*(2*cxy + c2))/((mx*mx + my*my + c1)*(vx + vy + c2))
+    return s.mean()
+
+def neural(name):
+    def run(low, up_amt):
+        from lunar_landing_sim import get_sr_model
+        kwargs = {'scale': up_amt} if name == 'edsr' else {}
+        img = np.clip(low, 0, 255).astype(np.uint8)
+        return get_sr_model(name, **kwargs).upsample(img, up_amt)
+    return run
+
+# name -> (fn(low, up_amt), grid). full_procedure and diamond square use the
+# parameters from upsampling_lunar_lander's __main__ with a fixed noise seed
+BACKENDS = {
+    'just_bilinear': (just_bilinear, True),
+    'just_bicubic': (lambda im, u: upsample(im, u, bicubic, 1/u, -1/2), True),
+    'full_procedure': (lambda im, u: full_procedure(im, u, 0.7, .7, 2, avg_test, 25,
+                                                    rng=np.random.default_rng(0)), True),
+    'just_diamond_square': (lambda im, u: just_diamond_square(im, u, cr_spline, 25,
+                                                              rng=np.random.default_rng(0)), True),
+    'PIL_bilinear': (PIL_bilinear, False),
+    'PIL_bicubic': (PIL_bicubic, False),
+    'PIL_lanczos': (PIL_lanczos, False),
+    'isr': (neural('isr'), False),
+    'edsr': (neural('edsr'), False),
+}
+
+BENCH_FIELDS = [('frame', 'i4'), ('backend', 'U24'), ('scale', 'i4'), ('wall_time', 'f8'), ('peak_mb', 'f8'),
+                ('psnr', 'f8'), ('ssim', 'f8')]
+
+# one untimed warm-up run (backends import their dependencies and load models on
+# first use), then the best of repeat wall times
+def measure(fn, low, up_amt, repeat=3):
+    fn(low, up_amt)
+    wall = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(low, up_amt)
+        wall = min(wall, time.perf_counter() - t0)
+    return out, wall
+
+# peak memory of one call, in MB above the RSS before it: imports and model
+# loading are triggered on a small crop first, then the linux RSS high-water mark
+# is reset and the full call made. run in a fresh interpreter (measure_peak) so
+# heap kept from earlier runs cannot hide the allocation, and PIL, numpy and
+# model buffers all count alike. nan where the high-water mark cannot be reset
+def peak_worker(name, low, up_amt):
+    fn = BACKENDS[name][0]
+    fn(low[:32, :32], up_amt)
+    base = current_rss()
+    if base is None or not reset_peak_rss():
+        return np.nan
+    fn(low, up_amt)
+    return (peak_rss() - base)/2**20
+
+def measure_peak(name, low, up_amt):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(peak_worker, name, low, up_amt).result()
+
+# runs every backend on every frame at every scale. backends whose dependencies
+# or weights are missing are reported and skipped
+def benchmark(frames, scales=(2, 4), backends=None, repeat=3, verbose=True):
+    rows = []
+    for name in (backends or list(BACKENDS)):
+        fn, grid = BACKENDS[name]
+        try:
+            for u in scales:
+                for i, truth in enumerate(frames):
+                    low, ref = degrade(np.asarray(truth, dtype=np.float64), u, grid)
+                    out, wall = measure(fn, low, u, repeat)
+                    peak = measure_peak(name, low, u)
+                    out = np.asarray(out, dtype=np.float64)[:ref.shape[0], :ref.shape[1]]
+                    rows.append((i, name, u, wall, peak, psnr(ref, out), ssim(ref, out)))
+                    if verbose:
+                        print('%-20s x%d frame %d: %.4fs %.1fMB psnr %.2f ssim %.4f' % ((name, u, i) + rows[-1][3:]))
+        except (ImportError, OSError) as e:
+            if verbose:
+                print('%-20s skipped: %s' % (name, e))
+    return np.array(rows, dtype=BENCH_FIELDS)
+
+# fastest backend per scale whose mean psnr/ssim over the frames clear the bar
+def pick_backend(table, min_psnr=0., min_ssim=0.):
+    best = {}
+    for u in np.unique(table['scale']):
+        cands = []
+        for name in np.unique(table['backend'][table['scale'] == u]):
+            sel = table[(table['scale'] == u) & (table['backend'] == name)]
+            if sel['psnr'].mean() >= min_psnr and sel['ssim'].mean() >= min_ssim:
+                cands.append((sel['wall_time'].mean(), name))
+        best[int(u)] = min(cands)[1] if cands else None
+    return best
+
+def load_frames(fnames):
+    return [np.asarray(open_gray(f), dtype=np.float64) for f in fnames]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='upsampling backend benchmark; synthetic terrain unless --images')
+    parser.add_argument('--images', nargs='+', default=None, help='reference frames (grayscale is used)')
+    parser.add_argument('--frames', type=int, default=3, help='number of synthetic frames')
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scales', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--backends', nargs='+', default=None, choices=list(BACKENDS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-psnr', type=float, default=0.)
+    parser.add_argument('--min-ssim', type=float, default=0.)
+    parser.add_argument('--out', default=None, help='.npz file for the results table')
+    args = parser.parse_args()
+
+    if args.images:
+        frames = load_frames(args.images)
+    else:
+        frames = [crater_terrain(args.size, seed=args.seed + i) for i in range(args.frames)]
+    table = benchmark(frames, args.scales, args.backends, args.repeat)
+    print(' '.join(name for name, _ in BENCH_FIELDS))
+    for row in table:
+        print(' '.join('%g' % v if not isinstance(v, str) else v for v in row.tolist()))
+    for u, name in pick_backend(table, args.min_psnr, args.min_ssim).items():
+        print('x%d: fastest backend meeting the bar: %s' % (u, name))
+    if args.out is not None:
+        np.savez(args.out, table=table)
@@ -3,14 +3,17 @@
 #--------------------------------------------------------------------#
 
 import numpy as np
-import matplotlib.pyplot as plt
+import random
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 
 from upsampling_utils import  diamond_square_algorithm, bilinear, cr_spline, avg_test
-from scipy.signal import butter,filtfilt
-from keras.preprocessing.image import load_img, img_to_array, array_to_img, save_img
 
 from PIL import Image
 
+# scipy (b_filt) and keras/matplotlib (__main__) are imported where they are used,
+# so importing the upsamplers stays cheap for workers that never filter
+
 # recombines two images. either basic addition or weighted average
 # depending on choice of beta (None or 0 <= b <=1)
 def image_recomb(image1, image2, b):
@@ -20,95 +23,288 @@ def image_recomb(image1, image2, b):
         return image1*b + image2*(1-b)
 
 
+# Keys cubic convolution weights for the 4 taps around fraction t (a = -1/2 is
+# Catmull-Rom), shape t.shape + (4,)
+def cubic_weights(t, a=-0.5):
+    d = np.abs(np.stack((1 + t, t, 1 - t, 2 - t), axis=-1))
+    near = ((a + 2)*d - (a + 3))*d*d + 1
+    far = ((a*d - 5*a)*d + 8*a)*d - 4*a
+    return np.where(d <= 1, near, np.where(d < 2, far, 0))
+
+def linear_weights(t):
+    return np.stack((1 - t, t), axis=-1)
+
+# source indices and weights for every output row/column of an n-point axis
+# upsampled by up_amt on the corner-aligned grid (output k sits at k/up_amt).
+# steps is the sample spacing inside a cell (1/up_amt for a uniform grid)
+def axis_taps(n, up_amt, taps, step=None):
+    step = 1/up_amt if step is None else step
+    k = np.arange(up_amt*(n - 1) + 1)
+    cell = np.minimum(k // up_amt, n - 2)
+    t = (k - cell*up_amt)*step
+    if taps == 2:
+        idx = cell[:, None] + np.arange(2)
+        w = linear_weights(t)
+    else:
+        idx = np.clip(cell[:, None] + np.arange(-1, 3), 0, n - 1)
+        w = taps(t)
+    return idx, w
+
+# separable interpolation over the whole image: rows then columns
+def separable_upsample(im, up_amt, taps, step=None):
+    iy, wy = axis_taps(im.shape[0], up_amt, taps, step)
+    ix, wx = axis_taps(im.shape[1], up_amt, taps, step)
+    rows = np.einsum('rk,rkc->rc', wy, im[iy])
+    return np.einsum('ck,rck->rc', wx, rows[:, ix])
+
+# all cell outputs (H-1, W-1, up_amt+1, up_amt+1) summed into the output and
+# divided by how many cells cover each pixel: the same averaging of shared edges
+# and corners the old per-cell loop did by halving
+def overlap_average(cells, up_amt):
+    ch, cw = cells.shape[:2]
+    u = up_amt
+    out = np.zeros((ch*u + 1, cw*u + 1))
+    cnt = np.zeros_like(out)
+    out[:-1, :-1] += cells[:, :, :u, :u].transpose(0, 2, 1, 3).reshape(ch*u, cw*u)
+    out[:-1, u::u] += cells[:, :, :u, u].transpose(0, 2, 1).reshape(ch*u, cw)
+    out[u::u, :-1] += cells[:, :, u, :u].reshape(ch, cw*u)
+    out[u::u, u::u] += cells[:, :, u, u]
+    cnt[:-1, :-1] += 1
+    cnt[:-1, u::u] += 1
+    cnt[u::u, :-1] += 1
+    cnt[u::u, u::u] += 1
+    return out / cnt
+
+# the 2x2 corners of every cell, (H-1, W-1) each
+def cell_corners(im):
+    return im[:-1, :-1], im[:-1, 1:], im[1:, :-1], im[1:, 1:]
+
+# stand-in for the old per-cell bicubic branch (which referenced an undefined
+# function): upsample(im, up_amt, bicubic, ratio, coeff) runs the whole-image
+# cubic convolution, ratio being the sample spacing and coeff the Keys a
+def bicubic(im, up_amt, ratio, coeff):
+    return separable_upsample(im, up_amt, lambda t: cubic_weights(t, coeff), ratio)
+
+# one (up_amt+1)x(up_amt+1) window with its corners filled in, the input the
+# upsampling_utils functions take
+def corner_window(tl, tr, bl, br, up_amt):
+    pre_im = np.zeros((up_amt + 1, up_amt + 1))
+    pre_im[0, 0] = tl
+    pre_im[0,-1] = tr
+    pre_im[-1, 0] = bl
+    pre_im[-1,-1] = br
+    return pre_im
+
+# upsampling_utils.bilinear is only swapped for the whole-image version when it
+# fills a window like plain corner-aligned bilinear interpolation (checked on one
+# window with an xy term), otherwise upsample keeps calling it per window
+def is_bilinear(up_amt):
+    corners = np.array([[0., 1.], [2., 4.]])
+    out = np.asarray(bilinear(corner_window(0., 1., 2., 4., up_amt)), dtype=np.float64)
+    return out.shape == (up_amt + 1, up_amt + 1) and np.allclose(out, separable_upsample(corners, up_amt, 2))
+
 # takes an image and upsampling method (function) as input
 # applies that function to each set of 4 points in a moving window
-# combines to make final upsampled image
-def upsample(im, up_amt, up_func, *extra_ps):
-        up_im = np.zeros((up_amt*im.shape[0] - (up_amt - 1), up_amt*im.shape[1] - (up_amt - 1)))
+# combines to make final upsampled image (points shared by neighbouring windows
+# are averaged). bilinear and bicubic run on all windows at once. any other
+# function is called per window: that includes the diamond square algorithm,
+# which lives in upsampling_utils with its own noise draws and is not rewritten
+# here, so only its loop overhead is left. the per-window functions draw noise
+# from the global generators, so a given rng seeds those first and tiled runs
+# stay reproducible
+def upsample(im, up_amt, up_func, *extra_ps, rng=None):
+        im = np.asarray(im, dtype=np.float64)
+        if up_func == bicubic:
+            return bicubic(im, up_amt, *extra_ps)
+        if up_func == bilinear and is_bilinear(up_amt):
+            return separable_upsample(im, up_amt, 2)
+        if rng is not None:
+            seed = int(rng.integers(2**32))
+            random.seed(seed)
+            np.random.seed(seed)
+
+        # note: diamond square algorithm takes a matrix of the correct output size
+        # with the filled in corners as input 
         sub_size = 1 + up_amt # 2 would give 3, 4 would give 5, 6 would give 7 etc.
+        cells = np.zeros((im.shape[0] - 1, im.shape[1] - 1, sub_size, sub_size))
+        tl, tr, bl, br = cell_corners(im)
         for i in range(im.shape[0] - 1):
             for j in range(im.shape[1] - 1):
-                # upsample grid
-                        # note: diamond square algorithm takes a matrix of the correct output size
-                        # with the filled in corners as input 
-                        # so take a square of correct output size, fill corners with adjacent 4 points
-                        # in 2x2 square you are upsampling
-                        if up_func == bicubic:
-                            pre_im = np.zeros((up_amt*2, up_amt*2))
-                            print(pre_im)
-                            sub_out = up_func(pre_im, *extra_ps)    
-                        else:
-                                pre_im = np.zeros((sub_size, sub_size))
-                                print(sub_size)
-                                pre_im[0, 0] = im[i,j]
-                                pre_im[0,-1] = im[i,j+1]
-                                pre_im[-1, 0] = im[i+1, j]
-                                pre_im[-1,-1] = im[i+1,j+1]
-                                print(pre_im)
-                                sub_out = up_func(pre_im, *extra_ps)
-
-                        # add to matrix
-                        up_im[i*up_amt:i*up_amt+sub_size, j*up_amt:j*up_amt+sub_size] += sub_out
-                        # scale new_left + old right to get average
-                        if j != 0 and i < im.shape[0] - 2: 
-                            up_im[i*up_amt:i*up_amt+sub_size-1, j*up_amt] /= 2 
-
-                        elif j != 0 and i == im.shape[0] - 2:
-                            up_im[i*up_amt:i*up_amt+sub_size, j*up_amt] /= 2 
-
-                # adjust new top row with previous bottom row 
-            if i != 0:
-                up_im[i*up_amt,:] /= 2
-                # pixels that overlap horizontally and vertically
-
-        return up_im
+                cells[i, j] = up_func(corner_window(tl[i, j], tr[i, j], bl[i, j], br[i, j], up_amt), *extra_ps)
+        return overlap_average(cells, up_amt)
 
 def b_filt(data, freq, order, ftype):
+    from scipy.signal import butter, filtfilt
     b, a = butter(order, freq, btype=ftype, analog=False)
     y = filtfilt(b,a,data)
     return y
 
 # takes image, splits into high and low frequency components, applies upsample to each
 # then recombines them. returns the complete upsampled image
-def full_procedure(im, up_amt, cutoff_freq, beta, order, ds_func, ds_temp):
+def full_procedure(im, up_amt, cutoff_freq, beta, order, ds_func, ds_temp, rng=None):
     #import pdb; pdb.set_trace()
+        im = np.asarray(im, dtype=np.float64)
         low_f_im = b_filt(im, cutoff_freq, order, 'low')
         low_fu_im = upsample(low_f_im, up_amt, bilinear)
 
         #breakpoint()
         high_f_im = b_filt(im, cutoff_freq, order, 'high')
-        high_fu_im = upsample(high_f_im, up_amt, diamond_square_algorithm, ds_func, ds_temp)
+        high_fu_im = upsample(high_f_im, up_amt, diamond_square_algorithm, ds_func, ds_temp, rng=rng)
 
         out_im = image_recomb(low_fu_im, high_fu_im, beta) 
 
         return out_im
 
+# tiles of tile x tile cells over an H x W grid of points. yields the tile index,
+# the core window (y0, y1, x0, x1, inclusive point ranges) and the window to read,
+# widened by halo_y/halo_x points and clipped to the image
+def tile_windows(H, W, tile, halo_y, halo_x):
+    for ty, y0 in enumerate(range(0, max(H - 1, 1), tile)):
+        for tx, x0 in enumerate(range(0, max(W - 1, 1), tile)):
+            y1, x1 = min(y0 + tile, H - 1), min(x0 + tile, W - 1)
+            read = (max(0, y0 - halo_y), min(H, y1 + 1 + halo_y), max(0, x0 - halo_x), min(W, x1 + 1 + halo_x))
+            yield (ty, tx), (y0, y1, x0, x1), read
+
+# halos for full_procedure tiles: b_filt runs filtfilt along rows only, so x gets
+# enough points for the IIR response to settle (longer for cutoffs near 0 or 1),
+# y only the interpolation support
+def procedure_halos(order, cutoff_freq, filt_halo=None):
+    if filt_halo is None:
+        filt_halo = max(3*(order + 1), int(np.ceil(4*order/min(cutoff_freq, 1 - cutoff_freq))))
+    return 2, filt_halo + 2
+
+# output rows/cols owned by a tile. the last row/col of a core is shared with the
+# next tile, which owns it, so every output pixel is written by exactly one tile
+def core_slices(core, up_amt, H, W):
+    y0, y1, x0, x1 = core
+    return (slice(y0*up_amt, y1*up_amt + (1 if y1 == H - 1 else 0)),
+            slice(x0*up_amt, x1*up_amt + (1 if x1 == W - 1 else 0)))
+
+# upsampled part of one tile owned by it (see core_slices): run fn on the read
+# window and cut that part back out
+def tile_core(fn, block, up_amt, core, read, H, W):
+    ys, xs = core_slices(core, up_amt, H, W)
+    oy, ox = read[0]*up_amt, read[2]*up_amt
+    return fn(block)[ys.start - oy:ys.stop - oy, xs.start - ox:xs.stop - ox]
+
+# output array for an H x W source: a .npy memmap when given a path
+def open_output(out, H, W, up_amt, dtype=np.float64):
+    shape = (up_amt*(H - 1) + 1, up_amt*(W - 1) + 1)
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    return out
+
+# out-of-core full_procedure for images that do not fit in memory. src is an
+# array or memmap (or a .npy path, opened memory-mapped), out a .npy path for a
+# memmapped result (or an array). tiles are read with halos, processed in memory
+# and their cores written out, so peak memory follows tile, not image size.
+# matches full_procedure up to small differences at tile seams (the IIR filter
+# is truncated at the halo and diamond square noise is drawn per tile, seeded by
+# seed and the tile index)
+def full_procedure_tiled(src, up_amt, cutoff_freq, beta, order, ds_func, ds_temp, out=None, tile=512,
+                         filt_halo=None, seed=None):
+    src = np.load(src, mmap_mode='r') if isinstance(src, str) else src
+    H, W = src.shape
+    out = open_output(out, H, W, up_amt)
+    hy, hx = procedure_halos(order, cutoff_freq, filt_halo)
+    for idx, core, read in tile_windows(H, W, tile, hy, hx):
+        rng = np.random.default_rng(None if seed is None else (seed,) + idx)
+        fn = lambda b: full_procedure(b, up_amt, cutoff_freq, beta, order, ds_func, ds_temp, rng=rng)
+        block = np.asarray(src[read[0]:read[1], read[2]:read[3]], dtype=np.float64)
+        out[core_slices(core, up_amt, H, W)] = tile_core(fn, block, up_amt, core, read, H, W)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+# state of a parallel_tiles worker: the shared input/output and the operation
+TILE_WORKER = {}
+
+def attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def init_tile_worker(src, dst, op, up_amt, args, seed):
+    TILE_WORKER['src'] = attach(*src)
+    TILE_WORKER['dst'] = attach(*dst)
+    TILE_WORKER['job'] = (op, up_amt, args, seed)
+
+def tile_worker(task):
+    idx, core, read = task
+    op, up_amt, args, seed = TILE_WORKER['job']
+    src = TILE_WORKER['src'][1]
+    dst = TILE_WORKER['dst'][1]
+    rng = np.random.default_rng(None if seed is None else (seed,) + idx)
+    fn = lambda b: op(b, up_amt, *args, rng=rng)
+    dst[core_slices(core, up_amt, *src.shape)] = tile_core(fn, src[read[0]:read[1], read[2]:read[3]], up_amt,
+                                                           core, read, *src.shape)
+    return idx
+
+# runs op(block, up_amt, *args, rng=rng) over halo-padded tiles on a process pool.
+# op is upsample, full_procedure or just_diamond_square (anything importable that
+# takes rng=). input and output live in shared memory, so only tile coordinates
+# are sent to the workers; each output pixel is written by exactly one tile and
+# every tile draws its noise from an RNG seeded by seed and its index, so the
+# result does not depend on the number of workers
+def parallel_tiles(op, im, up_amt, *args, tile=512, halo=None, workers=None, seed=None):
+    im = np.asarray(im, dtype=np.float64)
+    H, W = im.shape
+    if halo is None:
+        halo = procedure_halos(args[2], args[0]) if op is full_procedure else (2, 2)
+    shape = (up_amt*(H - 1) + 1, up_amt*(W - 1) + 1)
+    src = shared_memory.SharedMemory(create=True, size=im.nbytes)
+    dst = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*8)
+    try:
+        np.ndarray(im.shape, dtype=np.float64, buffer=src.buf)[:] = im
+        tasks = list(tile_windows(H, W, tile, *halo))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_tile_worker,
+                                 initargs=((src.name, im.shape, np.float64), (dst.name, shape, np.float64),
+                                           op, up_amt, args, seed)) as pool:
+            list(pool.map(tile_worker, tasks))
+        return np.ndarray(shape, dtype=np.float64, buffer=dst.buf).copy()
+    finally:
+        src.close()
+        src.unlink()
+        dst.close()
+        dst.unlink()
+
+# f is a file name or an already loaded grayscale image (array or PIL)
+def open_gray(f):
+    if isinstance(f, str):
+        return Image.open(f).convert('L')
+    if isinstance(f, Image.Image):
+        return f.convert('L')
+    return Image.fromarray(np.clip(np.asarray(f), 0, 255).astype(np.uint8))
+
 def just_bilinear(f, up_amt):
-    im = Image.open(f)
+    im = Image.open(f) if isinstance(f, str) else f
     return upsample(im, up_amt, bilinear)
 
-def just_diamond_square(im, up_amt, ds_func, ds_temp):
-    return upsample(im, up_amt, diamond_square_algorithm, ds_func, ds_temp)
+def just_diamond_square(im, up_amt, ds_func, ds_temp, rng=None):
+    return upsample(im, up_amt, diamond_square_algorithm, ds_func, ds_temp, rng=rng)
 
 def just_bicubic(im, up_amt, ratio, coeff):
     return upsample(im, up_amt, bicubic, ratio, coeff)
 
 def PIL_bilinear(f, up_amt):
-    im = Image.open(f).convert('L')
+    im = open_gray(f)
     im = im.resize((im.size[0]*up_amt, im.size[1]*up_amt) , resample = Image.BILINEAR)
     return np.asarray(im)
 
 def PIL_bicubic(f, up_amt):
-    im = Image.open(f).convert('L')
+    im = open_gray(f)
     im = im.resize((im.size[0]*up_amt, im.size[1]*up_amt) , resample = Image.BICUBIC)
     return np.asarray(im)
 
 def PIL_lanczos(f, up_amt):
-    im = Image.open(f).convert('L')
+    im = open_gray(f)
     im = im.resize((im.size[0]*up_amt, im.size[1]*up_amt) , resample = Image.LANCZOS)
     return np.asarray(im)
 
 if __name__ == '__main__':
+        import matplotlib.pyplot as plt
+        from keras.preprocessing.image import load_img, save_img
         im = np.array(load_img('images/apollo_images/apollo113km.png', color_mode='grayscale'))
         #up_im = full_procedure(im, 4, 0.7, .7, 2, cr_spline, 25)
         #up_im = full_procedure(im, 2, 0.7, .7, 2, avg_test, 25)